@@ -0,0 +1,234 @@
+"""
+Offline evaluation for the Leaf Doctor model.
+
+Streams a folder of labeled leaf images (e.g. apple_black_rot_1.JPG, the same
+naming used in database.json) through the inference backends and reports a
+confusion matrix, per-class precision/recall and images per second.
+
+Usage:
+    python evaluate.py path/to/images --backend all --batch-size 32 --workers 4
+"""
+import argparse
+import json
+import os
+import queue
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from utils.ai_brain import BACKENDS, CLASS_NAMES, predict_batch, preprocess_image
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png"}
+
+# --- 1. DATASET ---
+def label_from_path(path):
+    """
+    Returns the CLASS_NAMES index for a file, or None if it can't be labeled.
+    The filename prefix wins ('apple_black_rot_1.JPG'); the parent folder name
+    is used as a fallback for class-per-folder layouts.
+    """
+    stem = os.path.splitext(os.path.basename(path))[0].lower()
+    stem = re.sub(r"[_\- ]*\(?\d+\)?$", "", stem)
+    if stem in CLASS_NAMES:
+        return CLASS_NAMES.index(stem)
+
+    # Longest matching prefix, so 'apple_scab_leaf' still maps to 'apple_scab'
+    matches = [name for name in CLASS_NAMES if stem.startswith(name)]
+    if matches:
+        return CLASS_NAMES.index(max(matches, key=len))
+
+    parent = os.path.basename(os.path.dirname(path)).lower()
+    if parent in CLASS_NAMES:
+        return CLASS_NAMES.index(parent)
+    return None
+
+def scan_folder(folder):
+    samples, skipped = [], []
+    for root, _, files in os.walk(folder):
+        for name in sorted(files):
+            if os.path.splitext(name)[1].lower() not in IMAGE_EXTENSIONS:
+                continue
+            path = os.path.join(root, name)
+            label = label_from_path(path)
+            if label is None:
+                skipped.append(path)
+            else:
+                samples.append((path, label))
+    return samples, skipped
+
+def decode_image(path):
+    try:
+        with Image.open(path) as img:
+            return preprocess_image(img.convert("RGB"))
+    except Exception:
+        return None
+
+# --- 2. PARALLEL LOADING PIPELINE ---
+def stream_batches(samples, batch_size=32, workers=4, prefetch=4):
+    """
+    Yields (images, labels, unreadable_paths) batches.
+
+    A producer thread decodes each batch on a thread pool (PIL releases the
+    GIL while decoding) and keeps up to `prefetch` batches queued, so disk I/O
+    and JPEG decoding overlap with inference on the consumer side.
+    """
+    batches = queue.Queue(maxsize=max(1, prefetch))
+    stop = threading.Event()
+    done = object()
+
+    def producer():
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+                for start in range(0, len(samples), batch_size):
+                    if stop.is_set():
+                        break
+                    chunk = samples[start:start + batch_size]
+                    arrays = list(pool.map(decode_image, [p for p, _ in chunk]))
+                    images, labels, bad = [], [], []
+                    for (path, label), arr in zip(chunk, arrays):
+                        if arr is None:
+                            bad.append(path)
+                        else:
+                            images.append(arr)
+                            labels.append(label)
+                    batch = (np.stack(images) if images else None, np.array(labels, dtype=np.int64), bad)
+                    while not stop.is_set():
+                        try:
+                            batches.put(batch, timeout=0.1)
+                            break
+                        except queue.Full:
+                            continue
+        except Exception as e:
+            batches.put(e)
+        finally:
+            batches.put(done)
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = batches.get()
+            if item is done:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        # Drain so a blocked producer can see the stop flag and exit
+        while thread.is_alive():
+            try:
+                batches.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+# --- 3. METRICS ---
+def compute_metrics(confusion):
+    true_pos = np.diag(confusion).astype(np.float64)
+    predicted = confusion.sum(axis=0)
+    actual = confusion.sum(axis=1)
+    precision = np.divide(true_pos, predicted, out=np.zeros_like(true_pos), where=predicted > 0)
+    recall = np.divide(true_pos, actual, out=np.zeros_like(true_pos), where=actual > 0)
+    total = confusion.sum()
+    accuracy = float(true_pos.sum() / total) if total else 0.0
+    return precision, recall, accuracy
+
+def evaluate_backend(samples, backend, batch_size=32, workers=4, prefetch=4):
+    n = len(CLASS_NAMES)
+    confusion = np.zeros((n, n), dtype=np.int64)
+    unreadable = []
+    infer_seconds = 0.0
+
+    # Warm up so model loading isn't counted as throughput
+    _, error_msg = predict_batch(np.zeros((1, 224, 224, 3), dtype=np.float32), backend=backend)
+    if error_msg:
+        return {"backend": backend, "error": error_msg}
+
+    start = time.perf_counter()
+    for images, labels, bad in stream_batches(samples, batch_size, workers, prefetch):
+        unreadable.extend(bad)
+        if images is None:
+            continue
+        t0 = time.perf_counter()
+        predictions, error_msg = predict_batch(images, backend=backend)
+        infer_seconds += time.perf_counter() - t0
+        if predictions is None:
+            return {"backend": backend, "error": error_msg}
+        np.add.at(confusion, (labels, np.argmax(predictions, axis=1)), 1)
+    wall_seconds = time.perf_counter() - start
+
+    precision, recall, accuracy = compute_metrics(confusion)
+    evaluated = int(confusion.sum())
+    return {
+        "backend": backend,
+        "images": evaluated,
+        "unreadable": unreadable,
+        "accuracy": accuracy,
+        "confusion_matrix": confusion.tolist(),
+        "per_class": {
+            name: {"precision": float(precision[i]), "recall": float(recall[i]), "support": int(confusion[i].sum())}
+            for i, name in enumerate(CLASS_NAMES)
+        },
+        "images_per_second": evaluated / wall_seconds if wall_seconds else 0.0,
+        "inference_images_per_second": evaluated / infer_seconds if infer_seconds else 0.0,
+    }
+
+# --- 4. REPORT ---
+def print_report(report):
+    print(f"\n=== Backend: {report['backend']} ===")
+    if "error" in report:
+        print(f"❌ {report['error']}")
+        return
+
+    print(f"Images: {report['images']} | Accuracy: {100 * report['accuracy']:.2f}%")
+    print(f"Throughput: {report['images_per_second']:.1f} img/s end-to-end, "
+          f"{report['inference_images_per_second']:.1f} img/s inference only")
+    if report['unreadable']:
+        print(f"⚠️ {len(report['unreadable'])} unreadable image(s) skipped")
+
+    width = max(len(name) for name in CLASS_NAMES)
+    print("\nConfusion matrix (rows = actual, columns = predicted):")
+    print(" " * width + " " + " ".join(f"{i:>5}" for i in range(len(CLASS_NAMES))))
+    for i, row in enumerate(report['confusion_matrix']):
+        print(f"{CLASS_NAMES[i]:<{width}} " + " ".join(f"{v:>5}" for v in row))
+
+    print(f"\n{'class':<{width}} {'precision':>9} {'recall':>7} {'support':>8}")
+    for i, name in enumerate(CLASS_NAMES):
+        stats = report['per_class'][name]
+        print(f"{name:<{width}} {stats['precision']:>9.3f} {stats['recall']:>7.3f} {stats['support']:>8}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate Leaf Doctor on a labeled image folder.")
+    parser.add_argument("folder", help="Folder of images named like apple_black_rot_1.JPG")
+    parser.add_argument("--backend", choices=list(BACKENDS) + ["all"], default="all")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 4, help="Decode threads")
+    parser.add_argument("--prefetch", type=int, default=4, help="Decoded batches to keep queued")
+    parser.add_argument("--json", dest="json_path", help="Also write the full report to this file")
+    args = parser.parse_args()
+
+    samples, skipped = scan_folder(args.folder)
+    if skipped:
+        print(f"⚠️ {len(skipped)} file(s) skipped: no class name in filename or folder")
+    if not samples:
+        raise SystemExit("No labeled images found.")
+    print(f"📂 {len(samples)} labeled image(s) found in {args.folder}")
+
+    backends = BACKENDS if args.backend == "all" else [args.backend]
+    reports = []
+    for backend in backends:
+        report = evaluate_backend(samples, backend, args.batch_size, args.workers, args.prefetch)
+        print_report(report)
+        reports.append(report)
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(reports, f, indent=4)
+        print(f"\n💾 Report written to {args.json_path}")
+
+if __name__ == "__main__":
+    main()
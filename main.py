@@ -13,7 +13,14 @@ import base64
 import requests
 import pandas as pd
 import uuid
-from utils.ai_brain import predict_disease
+from utils.ai_brain import predict_disease, get_live_version
+from utils.model_registry import ModelManager, list_versions, get_active_version
+from utils.similarity import EmbeddingIndex
+from utils.history_index import HistoryIndex, clear_user
+from utils.record_stream import iter_history, iter_posts, load_image
+from utils.write_behind import WriteBehindQueue
+from utils.file_lock import file_lock
+from utils.retention import CompactionJob, iter_archived, write_json_atomic, write_json_array_atomic, write_json_object_atomic
 
 # --- 1. CONFIGURATION ---
 st.set_page_config(page_title="Leaf Doctor", page_icon="🌿", layout="wide")
@@ -21,6 +28,8 @@ st.set_page_config(page_title="Leaf Doctor", page_icon="🌿", layout="wide")
 # --- 2. DATABASE & AUTH SYSTEM ---
 USERS_FILE = "users.json"
 HISTORY_FILE = "history.json"
+HISTORY_TOMBSTONES_FILE = "history_tombstones.json"
+HISTORY_COUNTS_FILE = "history_counts.json"
 POSTS_FILE = "posts.json"
 CHAT_FILE = "chat.json"
 
@@ -34,8 +43,90 @@ def load_data(file, default_data):
     return default_data
 
 def save_data(file, data):
-    with open(file, "w") as f:
-        json.dump(data, f, indent=4)
+    write_json_atomic(file, data)
+
+def file_signature(*files):
+    return tuple((os.path.getmtime(f), os.path.getsize(f)) if os.path.exists(f) else None for f in files)
+
+# history.json is never loaded whole: reads stream it and writes stream it
+# through to a new file, one record in memory at a time.
+# Tombstones count positions, so every rewrite of history.json or its
+# tombstones must hold the history lock (see utils/file_lock.py).
+
+# Live records per user, kept by the writers below (under the history lock)
+# so Clear History is a single tombstone update. The counts carry the history
+# file's signature; if something else rewrote it (compaction) they're rebuilt
+# with one scan.
+def save_history_counts(counts):
+    signature = file_signature(HISTORY_FILE)[0]
+    save_data(HISTORY_COUNTS_FILE, {"signature": signature and list(signature), "counts": counts})
+
+def load_history_counts(tombstones):
+    saved = load_data(HISTORY_COUNTS_FILE, {})
+    signature = file_signature(HISTORY_FILE)[0]
+    if "counts" in saved and saved.get("signature") == (signature and list(signature)):
+        return saved["counts"]
+    counts = {}
+    for user, _ in iter_history(HISTORY_FILE, tombstones):
+        counts[user] = counts.get(user, 0) + 1
+    save_history_counts(counts)
+    return counts
+
+def append_history(records):
+    """Appends (user, record) pairs, skipping records whose id is already stored for the user."""
+    new = {}
+    for user, record in records:
+        new.setdefault(user, []).append(record)
+    stored, counts = {}, {}
+
+    def new_records(user):
+        ids = stored.setdefault(user, set())
+        for record in new.pop(user, []):
+            if record.get('id') and record['id'] in ids:
+                continue
+            ids.add(record.get('id'))
+            counts[user] = counts.get(user, 0) + 1
+            yield user, record
+
+    def merged():
+        current = None
+        for user, record in iter_history(HISTORY_FILE, tombstones, images="load"):
+            if user != current:
+                if current is not None: yield from new_records(current)
+                current = user
+            stored.setdefault(user, set()).add(record.get('id'))
+            counts[user] = counts.get(user, 0) + 1
+            yield user, record
+        if current is not None: yield from new_records(current)
+        for user in list(new):
+            yield from new_records(user)
+
+    with file_lock(HISTORY_FILE):
+        tombstones = load_data(HISTORY_TOMBSTONES_FILE, {})
+        # Reset tombstones first: a crash in between resurrects cleared records
+        # instead of dropping new ones.
+        save_data(HISTORY_TOMBSTONES_FILE, {})
+        try:
+            write_json_object_atomic(HISTORY_FILE, merged())
+        except BaseException:
+            save_data(HISTORY_TOMBSTONES_FILE, tombstones)
+            raise
+        save_history_counts(counts)
+
+def clear_user_history(user):
+    with file_lock(HISTORY_FILE):
+        tombstones = load_data(HISTORY_TOMBSTONES_FILE, {})
+        counts = load_history_counts(tombstones)
+        # Tombstone first: if the counts save is lost, a stale count only over-covers
+        # records that are already gone
+        save_data(HISTORY_TOMBSTONES_FILE, clear_user(tombstones, user, counts.pop(user, 0)))
+        save_history_counts(counts)
+
+def stream_history(images="skip"):
+    try:
+        yield from iter_history(HISTORY_FILE, load_data(HISTORY_TOMBSTONES_FILE, {}), images=images)
+    except ValueError:
+        st.warning("⚠️ History file is damaged; showing the readable part only.")
 
 def hash_password(password):
     return hashlib.sha256(str.encode(password)).hexdigest()
@@ -49,9 +140,132 @@ def img_to_base64(image):
 def base64_to_img(base64_str):
     return Image.open(io.BytesIO(base64.b64decode(base64_str)))
 
+def record_image(record):
+    """Base64 image of a record, reading it back from disk if it was deferred."""
+    if isinstance(record.get('image'), Image.Image): return img_to_base64(record['image'].convert("RGB"))
+    if 'image' in record: return record['image']
+    if 'image_ref' in record: return load_image(record['image_ref'])
+    return None
+
+# Keyed on the deferred image_ref (path, byte range, record id), so a cache hit
+# doesn't touch the history file at all
+@st.cache_data(max_entries=512, show_spinner=False)
+def history_thumbnail(image_ref, size=160):
+    img = base64_to_img(load_image(image_ref))
+    # JPEG draft mode decodes at reduced scale instead of full resolution
+    img.draft("RGB", (size, size))
+    img = img.convert("RGB")
+    img.thumbnail((size, size))
+    return img
+
+# Loaded once per server process; inserts append to disk as they happen
+@st.cache_resource
+def get_similarity_index():
+    return EmbeddingIndex()
+
+@st.cache_resource
+def get_history_index():
+    return HistoryIndex()
+
+@st.cache_resource
+def get_compaction_job():
+    return CompactionJob()
+
+# --- WRITE-BEHIND PERSISTENCE ---
+# Scans, posts and comments from every session are queued and written in
+# groups by a background thread, so JPEG encoding and file rewrites stay off
+# the request path. history.json and posts.json are committed separately,
+# each rewritten once per batch. A failed batch is retried, so records,
+# posts and comments whose id is already stored are skipped.
+def commit_history(items):
+    records = []
+    for item in items:
+        record = dict(item['data']['record'])
+        if isinstance(record.get('image'), Image.Image):
+            record['image'] = img_to_base64(record['image'].convert("RGB"))
+        records.append((item['data']['user'], record))
+
+    # Takes the history lock, shared with Clear History and compaction
+    append_history(records)
+
+def commit_posts(items):
+    # Encode images before taking the lock
+    new_posts, comments = [], {}
+    for item in items:
+        data = item['data']
+        if item['kind'] == 'post':
+            post = dict(data, comments=list(data.get('comments', [])))
+            if isinstance(post.get('image'), Image.Image):
+                post['image'] = img_to_base64(post['image'].convert("RGB"))
+            new_posts.append(post)
+        else:
+            comments.setdefault(data['post_id'], []).append(data['comment'])
+
+    # Streamed rewrite: one stored post in memory at a time
+    def add_comments(post):
+        stored = {c.get('id') for c in post.setdefault('comments', []) if c.get('id')}
+        for comment in comments.get(post.get('id'), []):
+            if comment['id'] not in stored:
+                post['comments'].append(comment)
+                stored.add(comment['id'])
+        return post
+
+    def merged_posts():
+        stored = set()
+        for post in iter_posts(POSTS_FILE, images="load"):
+            stored.add(post.get('id'))
+            yield add_comments(post)
+        for post in new_posts:
+            if post['id'] not in stored:
+                stored.add(post['id'])
+                yield add_comments(post)
+
+    with file_lock(POSTS_FILE):
+        write_json_array_atomic(POSTS_FILE, merged_posts())
+
+@st.cache_resource
+def get_write_queue():
+    return WriteBehindQueue({"history": commit_history, "post": commit_posts, "comment": commit_posts},
+                            max_batch=32, max_delay=2.0, max_pending=1000, max_attempts=3)
+
+# posts.json is streamed with images deferred; each page reads back only its own images
+@st.cache_data(max_entries=2, show_spinner=False)
+def load_posts(signature):
+    posts = []
+    try:
+        posts.extend(iter_posts(POSTS_FILE, images="defer"))
+    except ValueError:
+        print("⚠️ Posts file is damaged; showing the readable part only.")
+    return posts
+
+def get_feed_posts():
+    """Stored posts plus this session's posts and comments that are still queued."""
+    queue = get_write_queue()
+    session = st.session_state.session_id
+    # Copy queued posts so merging comments never touches the queued data
+    posts = load_posts(file_signature(POSTS_FILE)) + [dict(p, comments=list(p.get('comments', []))) for p in queue.pending('post', session)]
+    posts_by_id = {p['id']: p for p in posts}
+    for data in queue.pending('comment', session):
+        if data['post_id'] in posts_by_id:
+            posts_by_id[data['post_id']].setdefault('comments', []).append(data['comment'])
+    return posts
+
+# One per server process; the watcher follows ACTIVE in the model registry
+@st.cache_resource
+def get_model_manager():
+    manager = ModelManager()
+    manager.start_watcher()
+    return manager
+
+get_model_manager()
+
+def get_user_history(user):
+    signature = file_signature(HISTORY_FILE, HISTORY_TOMBSTONES_FILE)
+    return get_history_index().records(
+        user, signature, lambda: [rec for u, rec in stream_history(images="defer") if u == user]
+    )
+
 users_db = load_data(USERS_FILE, {})
-history_db = load_data(HISTORY_FILE, {})
-posts_db = load_data(POSTS_FILE, [])
 chat_db = load_data(CHAT_FILE, [])
 
 # --- 3. SESSION STATE ---
@@ -62,6 +276,9 @@ if 'selected_crop' not in st.session_state: st.session_state.selected_crop = Non
 if 'dark_mode' not in st.session_state: st.session_state.dark_mode = True
 if 'voice_lang' not in st.session_state: st.session_state.voice_lang = 'English'
 if 'admin_mode' not in st.session_state: st.session_state.admin_mode = 'dashboard' 
+if 'history_page' not in st.session_state: st.session_state.history_page = 0
+if 'feed_page' not in st.session_state: st.session_state.feed_page = 0
+if 'session_id' not in st.session_state: st.session_state.session_id = str(uuid.uuid4())
 
 # --- 4. THEME ---
 if st.session_state.dark_mode:
@@ -159,6 +376,35 @@ def play_audio(disease_name):
         st.audio(buf, format='audio/mp3', start_time=0)
     except: pass
 
+def show_similar_cases(embedding, user, exclude=()):
+    index = get_similarity_index()
+    post_hits = index.search(embedding, k=3, kind="post", exclude=exclude)
+    history_hits = index.search(embedding, k=3, kind="history", user=user, exclude=exclude)
+    if not post_hits and not history_hits:
+        return
+
+    post_ids = {m['id'] for m, _ in post_hits}
+    posts_by_id = {p['id']: p for p in load_posts(file_signature(POSTS_FILE)) if p.get('id') in post_ids}
+    queue = get_write_queue()
+    posts_by_id.update({p['id']: p for p in queue.pending('post')})
+    history_by_id = {h['id']: h for h in get_user_history(user) if 'id' in h}
+    history_by_id.update({d['record']['id']: d['record'] for d in queue.pending('history') if d['user'] == user})
+    cases = [(posts_by_id.get(m['id']), score, "Community") for m, score in post_hits]
+    cases += [(history_by_id.get(m['id']), score, "Your History") for m, score in history_hits]
+    cases = [c for c in cases if c[0] is not None]
+    if not cases:
+        return
+
+    st.subheader("🔍 Similar Past Cases")
+    cols = st.columns(len(cases))
+    for col, (case, score, source) in zip(cols, cases):
+        with col:
+            try: st.image(case['image'] if isinstance(case.get('image'), Image.Image) else base64_to_img(record_image(case)), use_container_width=True)
+            except: st.caption("No Image")
+            st.caption(f"{source} • {case['disease']} • {case['timestamp']}")
+            st.caption(f"Match: {100 * max(score, 0):.0f}%")
+            if case.get('caption'): st.write(f"\"{case['caption']}\"")
+
 def go_home():
     st.session_state.internal_page = 'home'
     st.session_state.selected_crop = None
@@ -362,18 +608,24 @@ def main_app():
                                     st.write("---")
                                     play_audio(info['disease_name'])
                                     
-                                    # SAVE HISTORY
+                                    # SAVE HISTORY (encoded and written by the write-behind queue)
                                     user = st.session_state.user
-                                    if user not in history_db: history_db[user] = []
-                                    img_str = img_to_base64(final_image)
-                                    history_db[user].append({
+                                    scan_image = final_image.copy()
+                                    record_id = str(uuid.uuid4())
+                                    get_write_queue().enqueue("history", {"user": user, "record": {
+                                        "id": record_id,
                                         "timestamp": datetime.datetime.now().strftime("%Y-%m-%d %H:%M"),
                                         "crop": current_crop,
                                         "disease": info['disease_name'],
                                         "treatment": info['treatment'],
-                                        "image": img_str
-                                    })
-                                    save_data(HISTORY_FILE, history_db)
+                                        "image": scan_image
+                                    }}, session=st.session_state.session_id)
+
+                                    # SIMILAR CASES (search before indexing this scan)
+                                    embedding = result.get('embedding')
+                                    if embedding is not None:
+                                        show_similar_cases(embedding, user)
+                                        get_similarity_index().add(record_id, embedding, "history", user)
                                     
                                     st.divider()
                                     
@@ -393,11 +645,12 @@ def main_app():
                                                         "disease": info['disease_name'],
                                                         "timestamp": str(datetime.date.today()),
                                                         "caption": user_caption,
-                                                        "image": img_str,
+                                                        "image": scan_image,
                                                         "comments": []
                                                     }
-                                                    posts_db.append(new_post)
-                                                    save_data(POSTS_FILE, posts_db)
+                                                    get_write_queue().enqueue("post", new_post, session=st.session_state.session_id)
+                                                    if embedding is not None:
+                                                        get_similarity_index().add(new_post['id'], embedding, "post", st.session_state.user)
                                                     st.success("Posted to Community Feed!")
                                                 else:
                                                     st.error("Please write a longer caption.")
@@ -419,9 +672,8 @@ def main_app():
                 
                 if st.form_submit_button("Publish Post"):
                     if feed_caption and uploaded_feed_img:
-                        # Convert uploaded file to base64
-                        img_pil = Image.open(uploaded_feed_img)
-                        b64_str = img_to_base64(img_pil)
+                        # Encoded to base64 by the write-behind queue
+                        img_pil = Image.open(uploaded_feed_img).copy()
                         
                         new_post = {
                             "id": str(uuid.uuid4()),
@@ -430,11 +682,12 @@ def main_app():
                             "disease": "Update",
                             "timestamp": str(datetime.date.today()),
                             "caption": feed_caption,
-                            "image": b64_str,
+                            "image": img_pil,
                             "comments": []
                         }
-                        posts_db.append(new_post)
-                        save_data(POSTS_FILE, posts_db)
+                        # General photos (tools, harvest...) aren't leaf cases, so they
+                        # are not embedded or offered as similar cases
+                        get_write_queue().enqueue("post", new_post, session=st.session_state.session_id)
                         st.success("Published!")
                         st.rerun()
                     else:
@@ -442,18 +695,24 @@ def main_app():
 
         st.divider()
         
-        if not posts_db:
+        feed_posts = get_feed_posts()
+        if not feed_posts:
             st.info("No posts yet. Be the first to share a scan!")
         
-        # Show newest posts first
-        for i, post in enumerate(reversed(posts_db)):
+        # Show newest posts first, a page at a time
+        PAGE_SIZE = 10
+        total_pages = max(1, -(-len(feed_posts) // PAGE_SIZE))
+        page = min(st.session_state.feed_page, total_pages - 1)
+        page_posts = feed_posts[::-1][page * PAGE_SIZE:(page + 1) * PAGE_SIZE]
+
+        for post in page_posts:
             with st.container(border=True):
                 c_img, c_details = st.columns([1, 2])
                 
                 with c_img:
                     # Show Post Image
                     try:
-                        p_img = base64_to_img(post['image'])
+                        p_img = post['image'] if isinstance(post.get('image'), Image.Image) else base64_to_img(record_image(post))
                         st.image(p_img, use_container_width=True)
                     except: st.error("Image Error")
                 
@@ -484,18 +743,30 @@ def main_app():
                         new_comment_text = st.text_input("Write a reply...", placeholder="Suggest a cure...")
                         if st.form_submit_button("Reply"):
                             if new_comment_text:
-                                # Update Database
-                                # Need to find the original post in the NON-reversed list to update
-                                for db_post in posts_db:
-                                    if db_post['id'] == post['id']:
-                                        db_post['comments'].append({
-                                            "user": st.session_state.user,
-                                            "text": new_comment_text,
-                                            "time": str(datetime.datetime.now())
-                                        })
-                                        break
-                                save_data(POSTS_FILE, posts_db)
+                                # Queued; the flusher applies it to the stored post by id
+                                get_write_queue().enqueue("comment", {
+                                    "post_id": post['id'],
+                                    "comment": {
+                                        "id": str(uuid.uuid4()),
+                                        "user": st.session_state.user,
+                                        "text": new_comment_text,
+                                        "time": str(datetime.datetime.now())
+                                    }
+                                }, session=st.session_state.session_id)
                                 st.rerun()
+
+        if total_pages > 1:
+            c_prev, c_page, c_next = st.columns([1, 2, 1])
+            with c_prev:
+                if st.button("← Newer", key="feed_newer", disabled=page == 0):
+                    st.session_state.feed_page = page - 1
+                    st.rerun()
+            with c_page:
+                st.markdown(f"<p style='text-align:center;'>Page {page + 1} of {total_pages} ({len(feed_posts)} posts)</p>", unsafe_allow_html=True)
+            with c_next:
+                if st.button("Older →", key="feed_older", disabled=page >= total_pages - 1):
+                    st.session_state.feed_page = page + 1
+                    st.rerun()
     
     # --- GLOBAL CHAT TAB ---
     elif menu == "💬 Global Chat":
@@ -541,7 +812,9 @@ def main_app():
     elif menu == "📜 My History":
         st.title("📜 Scan History")
         user = st.session_state.user
-        user_history = history_db.get(user, [])
+        user_history = get_user_history(user)
+        # Read-your-writes: this session's scans that are still queued
+        queued_history = [d['record'] for d in get_write_queue().pending('history', st.session_state.session_id) if d['user'] == user]
         
         col_f1, col_f2 = st.columns(2)
         with col_f1: filter_crop = st.selectbox("Filter by Crop:", ["All", "Apple", "Corn", "Potato"])
@@ -549,28 +822,59 @@ def main_app():
             use_date = st.toggle("Filter by Date")
             filter_date = st.date_input("Select Date", datetime.date.today()) if use_date else None
 
-        if not user_history:
+        if not user_history and not queued_history:
             st.info("No scans found.")
         else:
             if st.button("🗑️ Clear History"):
-                history_db[user] = []
-                save_data(HISTORY_FILE, history_db)
-                st.rerun()
+                # Land queued scans first so they're covered by the tombstone;
+                # both writes take the history file lock
+                queue = get_write_queue()
+                queue.flush()
+                if any(d['user'] == user for d in queue.pending('history')):
+                    st.error("Some scans couldn't be saved yet, so history wasn't cleared. Please try again.")
+                else:
+                    clear_user_history(user)
+                    get_history_index().drop(user)
+                    get_similarity_index().remove_user(user, kind="history")
+                    st.rerun()
             
-            display_items = []
-            for item in user_history:
-                if filter_crop != "All" and item['crop'] != filter_crop: continue
-                if filter_date and item['timestamp'].split(" ")[0] != str(filter_date): continue
-                display_items.append(item)
+            signature = file_signature(HISTORY_FILE, HISTORY_TOMBSTONES_FILE)
+            matches = get_history_index().query(
+                user, signature,
+                lambda: [rec for u, rec in stream_history(images="defer") if u == user],
+                crop=None if filter_crop == "All" else filter_crop,
+                date=filter_date
+            )
+            matches = [
+                item for item in reversed(queued_history)
+                if (filter_crop == "All" or item['crop'] == filter_crop)
+                and (filter_date is None or item['timestamp'].split(" ")[0] == str(filter_date))
+            ] + matches
+
+            # Reset to the first page whenever the filters change
+            filter_key = (filter_crop, filter_date)
+            if st.session_state.get('history_filter') != filter_key:
+                st.session_state.history_filter = filter_key
+                st.session_state.history_page = 0
 
-            for item in reversed(display_items):
+            PAGE_SIZE = 10
+            total_pages = max(1, -(-len(matches) // PAGE_SIZE))
+            page = min(st.session_state.history_page, total_pages - 1)
+            page_items = matches[page * PAGE_SIZE:(page + 1) * PAGE_SIZE]
+
+            if not matches:
+                st.info("No scans match these filters.")
+
+            for item in page_items:
                 with st.container(border=True):
                     c_img, c_text = st.columns([1, 4])
                     with c_img:
-                        if "image" in item:
+                        if isinstance(item.get('image'), Image.Image):
+                            st.image(item['image'], use_container_width=True)
+                        elif "image_ref" in item:
                             try:
-                                recovered_img = base64_to_img(item["image"])
-                                st.image(recovered_img, use_container_width=True)
+                                thumb = history_thumbnail(tuple(item['image_ref']))
+                                st.image(thumb, use_container_width=True)
                             except: st.error("Img Error")
                         else: st.caption("No Image")
                     with c_text:
@@ -578,28 +882,43 @@ def main_app():
                         st.caption(f"📅 {item['timestamp']} | Crop: {item['crop']}")
                         st.write(f"**Cure:** {item['treatment']}")
 
+            if total_pages > 1:
+                c_prev, c_page, c_next = st.columns([1, 2, 1])
+                with c_prev:
+                    if st.button("← Newer", disabled=page == 0):
+                        st.session_state.history_page = page - 1
+                        st.rerun()
+                with c_page:
+                    st.markdown(f"<p style='text-align:center;'>Page {page + 1} of {total_pages} ({len(matches)} scans)</p>", unsafe_allow_html=True)
+                with c_next:
+                    if st.button("Older →", disabled=page >= total_pages - 1):
+                        st.session_state.history_page = page + 1
+                        st.rerun()
+
     # --- ADVANCED ADMIN DASHBOARD ---
     elif menu == "📊 Admin Dashboard":
         st.title("📊 Disease Surveillance Center")
         if st.session_state.admin_mode == 'dashboard':
             st.caption("Restricted Access: Administrator Only")
-            all_history = []
-            for u in history_db: all_history.extend(history_db[u])
-            if not all_history:
+            total_scans, active_users, last_scan = 0, set(), None
+            crop_counts = {}
+            disease_counts = {}
+            for u, h in stream_history():
+                total_scans += 1
+                active_users.add(u)
+                last_scan = h.get('timestamp')
+                c = h.get('crop', 'Unknown')
+                crop_counts[c] = crop_counts.get(c, 0) + 1
+                d = h.get('disease', 'Unknown')
+                disease_counts[d] = disease_counts.get(d, 0) + 1
+            if not total_scans:
                 st.warning("No data collected yet.")
             else:
                 c1, c2, c3 = st.columns(3)
-                c1.metric("Total Scans", len(all_history))
-                c2.metric("Active Users", len(history_db.keys()))
-                c3.metric("Last Scan", all_history[-1]['timestamp'])
+                c1.metric("Total Scans", total_scans)
+                c2.metric("Active Users", len(active_users))
+                c3.metric("Last Scan", last_scan)
                 st.divider()
-                crop_counts = {}
-                disease_counts = {}
-                for h in all_history:
-                    c = h.get('crop', 'Unknown')
-                    crop_counts[c] = crop_counts.get(c, 0) + 1
-                    d = h.get('disease', 'Unknown')
-                    disease_counts[d] = disease_counts.get(d, 0) + 1
                 chart1, chart2 = st.columns(2)
                 with chart1:
                     st.subheader("Crop Distribution")
@@ -609,6 +928,87 @@ def main_app():
                     st.bar_chart(disease_counts)
             st.write("")
             st.divider()
+            with st.expander("🧹 Storage Retention & Compaction"):
+                job = get_compaction_job()
+                r1, r2 = st.columns(2)
+                recompress_days = r1.number_input("Recompress images older than (days)", min_value=1, value=30)
+                archive_days = r2.number_input("Archive records older than (days)", min_value=1, value=180)
+                if job.running:
+                    st.info("⏳ Compaction running in the background...")
+                elif st.button("Run Compaction"):
+                    job.start(HISTORY_FILE, POSTS_FILE, {
+                        "recompress_after_days": recompress_days,
+                        "archive_after_days": archive_days,
+                    }, tombstones_file=HISTORY_TOMBSTONES_FILE, on_archived=get_similarity_index().remove)
+                    st.rerun()
+                if job.last_error:
+                    st.error(f"Compaction failed: {job.last_error}")
+                elif job.last_report:
+                    rep = job.last_report
+                    st.success(f"Reclaimed {rep['bytes_reclaimed'] / 1e6:.2f} MB • "
+                               f"{rep['images_recompressed']} images recompressed • {rep['records_archived']} records archived")
+            with st.expander("💾 Write-Behind Persistence"):
+                queue = get_write_queue()
+                wb = queue.metrics()
+                w1, w2, w3 = st.columns(3)
+                w1.metric("Queued Writes", wb['queued'])
+                w2.metric("Group Commits", wb['flushes'])
+                if wb['flushes']:
+                    w3.metric("Mean Batch", f"{wb['mean_batch']:.1f}")
+                    w4, w5 = st.columns(2)
+                    w4.metric("Flush p50 / p95", f"{wb['flush_p50_ms']:.0f} / {wb['flush_p95_ms']:.0f} ms")
+                    w5.metric("Enqueue→Durable p50 / p95", f"{wb['durable_p50_ms']:.0f} / {wb['durable_p95_ms']:.0f} ms")
+                if queue.last_error:
+                    st.error(f"Last flush failed: {queue.last_error}")
+                dead = queue.dead_letters()
+                if dead:
+                    st.warning(f"{len(dead)} write(s) failed {queue.max_attempts} times and were set aside.")
+                    st.dataframe(pd.DataFrame([{"kind": d['kind'], "attempts": d['attempts'], "error": d.get('error')} for d in dead]),
+                                 use_container_width=True)
+                    if st.button("Retry Failed Writes"):
+                        queue.retry_dead_letters()
+                        st.rerun()
+                if st.button("Flush Now"):
+                    queue.flush()
+                    st.rerun()
+            with st.expander("🧠 Model Registry"):
+                manager = get_model_manager()
+                versions = list_versions()
+                m1, m2 = st.columns(2)
+                m1.metric("Live Model", get_live_version() or "legacy / not loaded")
+                m2.metric("Active in Registry", get_active_version() or "-")
+                if manager.loading:
+                    st.info(f"⏳ Warming up {manager.loading} in the background...")
+                if manager.last_error:
+                    st.error(manager.last_error)
+                if not versions:
+                    st.caption("No versions registered. Use: python -m utils.model_registry register <file.h5>")
+                else:
+                    chosen = st.selectbox("Version", versions, index=len(versions) - 1)
+                    b1, b2 = st.columns(2)
+                    if b1.button("🔁 Promote to Live", disabled=manager.loading is not None):
+                        manager.promote(chosen)
+                        st.rerun()
+                    if manager.shadow_loading:
+                        st.info(f"⏳ Loading shadow candidate {manager.shadow_loading}...")
+                        if b2.button("⏹️ Cancel Shadow Load"):
+                            manager.stop_shadow()
+                            st.rerun()
+                    elif manager.shadow_version:
+                        if b2.button(f"⏹️ Stop Shadowing {manager.shadow_version}"):
+                            manager.stop_shadow()
+                            st.rerun()
+                    else:
+                        sample_rate = st.slider("Shadow traffic fraction", 0.01, 1.0, 0.1)
+                        if b2.button("👥 Shadow This Version"):
+                            manager.start_shadow(chosen, sample_rate)
+                            st.rerun()
+                    summary = manager.shadow_summary()
+                    if summary:
+                        s1, s2, s3 = st.columns(3)
+                        s1.metric("Agreement", f"{100 * summary['agreement']:.1f}%", help=f"{summary['samples']} sampled scans")
+                        s2.metric("Live p50 / p95", f"{summary['live_p50_ms']:.0f} / {summary['live_p95_ms']:.0f} ms")
+                        s3.metric("Shadow p50 / p95", f"{summary['shadow_p50_ms']:.0f} / {summary['shadow_p95_ms']:.0f} ms")
             if st.button("📂 View Raw Database Records (Table View)", type="primary"):
                 st.session_state.admin_mode = 'table'
                 st.rerun()
@@ -620,13 +1020,17 @@ def main_app():
                 if st.button("← Back to Charts"):
                     st.session_state.admin_mode = 'dashboard'
                     st.rerun()
+            t1, t2 = st.columns(2)
+            include_archive = t1.toggle("Include archived records")
+            show_images = t2.toggle("Show leaf images (first 200 rows)")
+            # Images stay on disk (image_ref) until a row is actually shown
             all_records = []
-            for user, history in history_db.items():
-                for record in history:
-                    rec = record.copy()
-                    rec['user'] = user
-                    if 'image' in rec: rec['image_display'] = f"data:image/jpeg;base64,{rec['image']}"
-                    else: rec['image_display'] = None
+            for user, rec in stream_history(images="defer"):
+                rec['user'] = user
+                all_records.append(rec)
+            if include_archive:
+                for rec in iter_archived("history"):
+                    rec.pop('image', None)
                     all_records.append(rec)
             if not all_records:
                 st.info("No records found.")
@@ -646,9 +1050,17 @@ def main_app():
                     start_d, end_d = date_range
                     df = df[(df['dt_obj'].dt.date >= start_d) & (df['dt_obj'].dt.date <= end_d)]
                 st.write(f"Showing {len(df)} records.")
-                cols_to_show = ['timestamp', 'user', 'crop', 'disease', 'image_display']
+                cols_to_show = ['timestamp', 'user', 'crop', 'disease']
+                if show_images:
+                    df = df.copy()
+                    refs = df['image_ref'] if 'image_ref' in df.columns else pd.Series(None, index=df.index)
+                    df['image_display'] = None
+                    for idx, ref in refs.iloc[:200].items():
+                        img_str = load_image(ref) if isinstance(ref, tuple) else None
+                        if img_str: df.at[idx, 'image_display'] = f"data:image/jpeg;base64,{img_str}"
+                    cols_to_show.append('image_display')
                 st.dataframe(df[cols_to_show], column_config={"image_display": st.column_config.ImageColumn("Leaf Image"), "timestamp": "Time", "user": "Farmer Name", "crop": "Crop Type", "disease": "Diagnosis"}, use_container_width=True, height=500)
-                clean_df = df.drop(columns=['image', 'image_display', 'dt_obj'], errors='ignore')
+                clean_df = df.drop(columns=['image', 'image_ref', 'image_display', 'dt_obj'], errors='ignore')
                 csv = clean_df.to_csv(index=False).encode('utf-8')
                 st.download_button(label="📥 Download Filtered Report (CSV)", data=csv, file_name="leaf_doctor_report.csv", mime="text/csv", type="primary")
 
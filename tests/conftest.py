@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The app is run from the repo root (streamlit run main.py); mirror that for imports
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,35 @@
+import threading
+
+from utils.file_lock import file_lock
+
+def test_nested_lock_on_one_thread_does_not_deadlock(tmp_path):
+    path = str(tmp_path / "history.json")
+    done = threading.Event()
+
+    def nested():
+        with file_lock(path):
+            with file_lock(path):
+                pass
+            with file_lock(path):
+                pass
+        done.set()
+
+    threading.Thread(target=nested, daemon=True).start()
+    assert done.wait(timeout=5)
+
+def test_lock_excludes_other_threads(tmp_path):
+    path = str(tmp_path / "history.json")
+    inside, results = threading.Event(), []
+
+    def other():
+        with file_lock(path):
+            results.append("other")
+
+    with file_lock(path):
+        with file_lock(path):
+            thread = threading.Thread(target=other, daemon=True)
+            thread.start()
+            thread.join(timeout=0.2)
+            results.append("owner")
+    thread.join(timeout=5)
+    assert results == ["owner", "other"]
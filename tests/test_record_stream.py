@@ -0,0 +1,138 @@
+import json
+import os
+import tracemalloc
+
+import pytest
+
+from utils.record_stream import iter_history, iter_posts, load_image
+from utils.retention import write_json_array_atomic, write_json_object_atomic
+
+N_RECORDS = 100_000
+IMAGE = "A" * 1024  # stands in for a base64 JPEG
+
+def _history(users, per_user, image=IMAGE):
+    return {
+        f"user{u}": [
+            {"id": f"{u}-{i}", "timestamp": "2026-01-01 10:00", "crop": "Apple",
+             "disease": "Apple Scab", "treatment": "Fungicide", "image": image}
+            for i in range(per_user)
+        ]
+        for u in range(users)
+    }
+
+@pytest.fixture(scope="module")
+def big_history(tmp_path_factory):
+    # Written user by user so building the fixture doesn't hold 100k records either
+    path = tmp_path_factory.mktemp("stream") / "history.json"
+    users, per_user = 1000, N_RECORDS // 1000
+    with open(path, "w") as f:
+        f.write("{")
+        for u in range(users):
+            chunk = json.dumps(_history(1, per_user)["user0"], indent=4)
+            f.write(("," if u else "") + f"\n    \"user{u}\": " + chunk)
+        f.write("\n}")
+    return str(path)
+
+def test_history_peak_memory_is_bounded_at_100k_records(big_history):
+    file_size = os.path.getsize(big_history)
+    tracemalloc.start()
+    try:
+        count = sum(1 for _ in iter_history(big_history))
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert count == N_RECORDS
+    # A few read chunks plus one record, independent of the number of records
+    assert peak < 8 * 1024 * 1024
+    assert peak < file_size / 10
+
+def test_deferred_images_keep_memory_bounded(big_history):
+    tracemalloc.start()
+    try:
+        refs = 0
+        for _, record in iter_history(big_history, images="defer"):
+            assert 'image' not in record
+            refs += 'image_ref' in record
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert refs == N_RECORDS
+    assert peak < 8 * 1024 * 1024
+
+def test_streamed_history_rewrite_is_bounded_at_100k_records(big_history, tmp_path):
+    # The write-behind flush and compaction rewrite history.json like this
+    out = str(tmp_path / "history.json")
+    tracemalloc.start()
+    try:
+        write_json_object_atomic(out, iter_history(big_history, images="load"))
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert peak < 8 * 1024 * 1024
+    count = 0
+    for a, b in zip(iter_history(big_history, images="load"), iter_history(out, images="load")):
+        assert a == b
+        count += 1
+    assert count == N_RECORDS
+    assert sum(1 for _ in iter_history(out)) == N_RECORDS
+
+def test_streamed_writers_match_json_load(tmp_path):
+    data = _history(3, 4, image="QUJD")
+    path = str(tmp_path / "history.json")
+    write_json_object_atomic(path, ((u, r) for u, recs in data.items() for r in recs))
+    assert json.load(open(path)) == data
+    write_json_object_atomic(path, [])
+    assert json.load(open(path)) == {}
+
+    with pytest.raises(ValueError):
+        write_json_object_atomic(path, [("a", 1), ("b", 2), ("a", 3)])
+    assert json.load(open(path)) == {}  # a failed write leaves the old file
+    assert not [f for f in os.listdir(tmp_path) if f.endswith(".tmp")]
+
+    posts = data["user0"]
+    write_json_array_atomic(path, iter(posts))
+    assert json.load(open(path)) == posts
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64, 4096, 1 << 20])
+def test_history_matches_json_load(tmp_path, chunk_size):
+    data = _history(3, 4, image="QUJD")
+    data["empty"] = []
+    data["user1"][2]["nested"] = {"list": [1, 2.5, {"s": "}],"}], "n": None}
+    path = tmp_path / "history.json"
+    path.write_text(json.dumps(data, indent=4))
+
+    expected = [(user, rec) for user, records in json.load(open(path)).items() for rec in records]
+    assert list(iter_history(str(path), images="load", chunk_size=chunk_size)) == expected
+
+    # Tombstones skip each user's first N records
+    got = list(iter_history(str(path), tombstones={"user0": 3}, images="load", chunk_size=chunk_size))
+    assert got == [(u, r) for u, r in expected if not (u == "user0" and r["id"] in ("0-0", "0-1", "0-2"))]
+
+@pytest.mark.parametrize("chunk_size", [1, 13, 1 << 20])
+def test_posts_match_json_load_and_defer_images(tmp_path, chunk_size):
+    posts = [{"id": str(i), "timestamp": "2026-01-01", "image": f"img{i}", "comments": [{"text": "hi"}]}
+             for i in range(20)]
+    path = tmp_path / "posts.json"
+    path.write_text(json.dumps(posts, indent=4))
+
+    assert list(iter_posts(str(path), images="load", chunk_size=chunk_size)) == posts
+    deferred = list(iter_posts(str(path), images="defer", chunk_size=chunk_size))
+    assert [load_image(p['image_ref']) for p in deferred] == [p['image'] for p in posts]
+
+def test_stale_image_ref_returns_none(tmp_path):
+    path = tmp_path / "posts.json"
+    path.write_text(json.dumps([{"id": "a", "image": "x"}, {"id": "b", "image": "y"}]))
+    ref = list(iter_posts(str(path), images="defer"))[1]['image_ref']
+    path.write_text(json.dumps([{"id": "c", "image": "z"}, {"id": "b", "image": "y"}]))
+    assert load_image(ref) == "y"
+    path.write_text(json.dumps([{"id": "b", "image": "y"}]))
+    assert load_image(ref) is None
+
+def test_missing_and_empty_files(tmp_path):
+    assert list(iter_history(str(tmp_path / "nope.json"))) == []
+    empty = tmp_path / "empty.json"
+    empty.write_text("")
+    assert list(iter_posts(str(empty))) == []
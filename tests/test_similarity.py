@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("tensorflow")  # utils.similarity takes EMBEDDING_DIM from ai_brain
+
+from utils.similarity import EmbeddingIndex
+
+def _index(tmp_path):
+    return EmbeddingIndex(str(tmp_path / "e.f16"), str(tmp_path / "e.jsonl"), dim=4,
+                          removed_file=str(tmp_path / "e.removed"))
+
+def test_removed_rows_are_never_returned_and_stay_removed(tmp_path):
+    index = _index(tmp_path)
+    query = np.ones(4)
+    for i in range(10):
+        index.add(f"h{i}", query + 0.01 * i, "history", "alice")
+    index.add("far", -query, "history", "alice")
+    index.add("p1", query, "post", "bob")
+
+    assert index.remove_user("alice", kind="history") == 11
+    assert index.search(query, k=3, kind="history", user="alice") == []
+    assert [m["id"] for m, _ in index.search(query, k=3)] == ["p1"]
+
+    reloaded = _index(tmp_path)
+    assert reloaded.remove(["p1", "unknown"]) == 1
+    reloaded.add("new", query, "history", "alice")
+    assert [m["id"] for m, _ in reloaded.search(query, k=3)] == ["new"]
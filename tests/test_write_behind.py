@@ -0,0 +1,53 @@
+import threading
+import time
+
+from utils.write_behind import WriteBehindQueue
+
+def _queue(commit, **kwargs):
+    kwargs.setdefault("max_delay", 0.2)
+    return WriteBehindQueue({"history": commit, "post": commit}, **kwargs)
+
+def test_single_item_is_committed_after_max_delay():
+    committed = threading.Event()
+    queue = _queue(lambda items: committed.set(), max_batch=32)
+    try:
+        # Let the flusher go idle on an empty queue first
+        time.sleep(0.1)
+        queue.enqueue("history", {"id": "a"})
+        assert committed.wait(timeout=2 * queue.max_delay + 0.5)
+        assert queue.pending("history") == []
+    finally:
+        queue.close()
+
+def test_full_batch_is_committed_before_max_delay():
+    batches = []
+    done = threading.Event()
+    def commit(items):
+        batches.append([i["data"] for i in items])
+        done.set()
+    queue = _queue(commit, max_batch=3, max_delay=30)
+    try:
+        for i in range(3):
+            queue.enqueue("history", i)
+        assert done.wait(timeout=2)
+        assert batches == [[0, 1, 2]]
+    finally:
+        queue.close()
+
+def test_failing_item_is_dead_lettered_and_others_land():
+    stored = []
+    def commit(items):
+        if any(i["data"] == "bad" for i in items):
+            raise OSError("disk says no")
+        stored.extend(i["data"] for i in items)
+    queue = _queue(commit, max_attempts=2, max_delay=0.01)
+    try:
+        for data in ("a", "bad", "b"):
+            queue.enqueue("history", data)
+        for _ in range(3):
+            queue.flush()
+        assert stored == ["a", "b"]
+        assert [d["data"] for d in queue.dead_letters()] == ["bad"]
+        assert queue.pending("history") == []
+    finally:
+        queue.close()
@@ -1,6 +1,8 @@
 import tensorflow as tf
 import numpy as np
 import os
+import threading
+import time
 from PIL import Image
 
 # --- CONFIGURATION ---
@@ -16,7 +18,30 @@ CLASS_NAMES = [
     'potato_late_blight'
 ]
 
-_model = None
+# Inference backends: the rebuilt Keras model (.h5 weights) and the TFLite
+# export that ships with the mobile app.
+BACKENDS = ("keras", "tflite")
+# mobile_brain.tflite is the export of the model above, minus the Rescaling
+# layer, so pixels are scaled to [0, 1] here to match Rescaling(1/255). The
+# scale belongs to this exported file: a re-export that keeps the Rescaling
+# layer (it becomes a plain MUL in the TFLite graph, so it can't be detected)
+# must ship with TFLITE_INPUT_SCALE = 1.0.
+# assets/model_unquant.tflite is a separate Teachable Machine export with an
+# unverified label order and is deliberately not used.
+TFLITE_MODEL = "mobile_brain.tflite"
+TFLITE_INPUT_SCALE = 1. / 255
+IMAGE_SIZE = (224, 224)
+
+EMBEDDING_LAYER = 'global_average_pooling2d'
+EMBEDDING_DIM = 1280
+
+# (version, model, dual model) for the live Keras model, swapped as one reference
+_live = None
+_interpreter = None  # (interpreter, input scale)
+_shadow_hook = None
+# One model load at a time, so a cold-start request and a registry hot-swap
+# of the same version don't build it twice
+_load_lock = threading.Lock()
 
 def build_model_structure():
     """
@@ -51,62 +76,215 @@ def build_model_structure():
     model = tf.keras.Model(inputs, outputs, name='sequential')
     return model
 
-def load_prediction_model():
-    global _model
-    if _model is not None:
-        return _model, None
-
-    # 1. Search for file
-    possible_locations = ["plant_disease_model.h5", "models/plant_disease_model.h5"]
-    selected_path = None
-    for path in possible_locations:
-        if os.path.exists(path):
-            selected_path = path
-            break
-            
-    if selected_path is None:
-        return None, "File not found on server."
-
-    # 2. THE REBUILD STRATEGY
+def load_model_from_path(selected_path):
+    """Rebuilds the architecture and loads weights from an .h5 file."""
+    # THE REBUILD STRATEGY
+    print(f"🏗️ Manually rebuilding architecture...")
+    model = build_model_structure()
+    
+    print(f"⚖️ Loading weights from {selected_path}...")
+    # We assume the file contains the weights. 
+    # by_name=True helps if there are slight naming mismatches.
     try:
-        print(f"🏗️ Manually rebuilding architecture...")
-        _model = build_model_structure()
-        
-        print(f"⚖️ Loading weights from {selected_path}...")
-        # We assume the file contains the weights. 
-        # by_name=True helps if there are slight naming mismatches.
-        try:
-            _model.load_weights(selected_path)
-        except Exception as w_err:
-            print("⚠️ Standard load failed, trying legacy mode...")
-            # Fallback for complex saves
-            _model.load_weights(selected_path, by_name=True, skip_mismatch=True)
-
-        print("✅ Model successfully reconstructed and loaded!")
-        return _model, None
+        model.load_weights(selected_path)
+    except Exception as w_err:
+        print("⚠️ Standard load failed, trying legacy mode...")
+        # Fallback for complex saves
+        model.load_weights(selected_path, by_name=True, skip_mismatch=True)
+
+    print("✅ Model successfully reconstructed and loaded!")
+    return model
+
+def install_model(model, version=None):
+    """
+    Warms `model` and makes it the live model. The (version, model, dual
+    model) triple is replaced as a single reference, so requests that already
+    grabbed the old one finish on it.
+    """
+    global _live
+    _live = (version, model, make_dual_model(model))
+
+def get_live_version():
+    live = _live
+    return live[0] if live else None
+
+def load_version(selected_path, version):
+    """Loads, warms and installs a registry version unless it is already live. Returns the model."""
+    with _load_lock:
+        live = _live
+        if live is not None and live[0] == version:
+            return live[1]
+        model = load_model_from_path(selected_path)
+        install_model(model, version)
+        return model
+
+def load_prediction_model():
+    live = _live
+    if live is not None:
+        return live[1], None
 
+    with _load_lock:
+        # Another request or the registry watcher may have loaded it while we waited
+        live = _live
+        if live is not None:
+            return live[1], None
+
+        # 1. Search for files: the registry's active version first, then legacy paths
+        from utils.model_registry import active_model_path
+        candidates = []
+        version, selected_path = active_model_path()
+        if selected_path is not None:
+            candidates.append((version, selected_path))
+        possible_locations = ["plant_disease_model.h5", "models/plant_disease_model.h5"]
+        candidates += [(None, path) for path in possible_locations if os.path.exists(path)]
+
+        if not candidates:
+            return None, "File not found on server."
+
+        # 2. Rebuild and load, falling back if the active version is broken
+        errors = []
+        for version, selected_path in candidates:
+            try:
+                model = load_model_from_path(selected_path)
+                install_model(model, version)
+                return model, None
+            except Exception as e:
+                print(f"⚠️ Loading {version or selected_path} failed: {e}")
+                errors.append(f"{version or selected_path}: {e}")
+        return None, f"Rebuild Failed: {'; '.join(errors)}"
+
+def load_tflite_interpreter():
+    global _interpreter
+    if _interpreter is not None:
+        return _interpreter, None
+
+    if not os.path.exists(TFLITE_MODEL):
+        return None, "TFLite model not found on server."
+
+    try:
+        print(f"📱 Loading TFLite model from {TFLITE_MODEL}...")
+        interpreter = tf.lite.Interpreter(model_path=TFLITE_MODEL)
+        interpreter.allocate_tensors()
     except Exception as e:
-        return None, f"Rebuild Failed: {str(e)}"
+        return None, f"TFLite Load Failed: {str(e)}"
 
-def predict_disease(image_file):
-    model, error_msg = load_prediction_model()
-    
-    if model is None:
-        return {"error": f"❌ {error_msg}"}
+    # Refuse to score a graph that doesn't emit one value per CLASS_NAMES entry
+    output_shape = interpreter.get_output_details()[0]['shape']
+    if output_shape[-1] != len(CLASS_NAMES):
+        return None, (f"TFLite model {TFLITE_MODEL} outputs {output_shape[-1]} classes, "
+                      f"expected {len(CLASS_NAMES)} to match CLASS_NAMES.")
+
+    _interpreter = (interpreter, TFLITE_INPUT_SCALE)
+    return _interpreter, None
+
+def preprocess_image(image_file):
+    """Resize a PIL image to the model input and return a float32 HxWx3 array."""
+    image = image_file.resize(IMAGE_SIZE)
+    img_array = np.asarray(image, dtype=np.float32)
 
-    # Prepare Image
-    target_size = (224, 224)
-    image = image_file.resize(target_size)
-    img_array = np.array(image)
-    
     # Ensure RGB
+    if img_array.ndim == 2:
+        img_array = np.stack([img_array] * 3, axis=-1)
     if img_array.shape[-1] == 4:
         img_array = img_array[..., :3]
-        
-    img_array = tf.expand_dims(img_array, 0) 
+    return img_array
+
+def _run_tflite(interpreter, input_scale, img_batch):
+    input_detail = interpreter.get_input_details()[0]
+    output_detail = interpreter.get_output_details()[0]
+    scale, zero_point = input_detail['quantization']
+    out_scale, out_zero_point = output_detail['quantization']
+
+    outputs = []
+    for img in img_batch:
+        x = img[np.newaxis, ...] * input_scale
+        # Quantized exports take integer input
+        if scale:
+            x = x / scale + zero_point
+        interpreter.set_tensor(input_detail['index'], x.astype(input_detail['dtype']))
+        interpreter.invoke()
+        y = interpreter.get_tensor(output_detail['index'])[0].astype(np.float32)
+        if out_scale:
+            y = (y - out_zero_point) * out_scale
+        outputs.append(y)
+    return np.stack(outputs)
+
+def make_dual_model(model):
+    """
+    Wraps the classifier so one forward pass returns both the pooled
+    1280-d embedding and the class scores.
+    """
+    embedding = model.get_layer(EMBEDDING_LAYER).output
+    dual_model = tf.keras.Model(model.inputs, [model.outputs[0], embedding], name='sequential_with_embedding')
+    dual_model.predict(np.zeros((1, 224, 224, 3), dtype=np.float32), verbose=0)
+    return dual_model
+
+def load_dual_model():
+    model, error_msg = load_prediction_model()
+    if model is None:
+        return None, error_msg
+    return _live[2], None
+
+def set_shadow_hook(hook):
+    """
+    Registers hook(img_batch, predictions, latency_seconds), called after each
+    live Keras prediction. Pass None to remove it.
+    """
+    global _shadow_hook
+    _shadow_hook = hook
+
+def predict_batch_with_embeddings(img_batch):
+    """Keras only. Returns (raw model outputs, embeddings, error message)."""
+    model, error_msg = load_dual_model()
+    if model is None:
+        return None, None, error_msg
+    start = time.perf_counter()
+    predictions, embeddings = model.predict(img_batch, verbose=0)
+    latency = time.perf_counter() - start
+
+    hook = _shadow_hook
+    if hook is not None:
+        try: hook(img_batch, predictions, latency)
+        except Exception as e: print(f"⚠️ Shadow hook failed: {e}")
+    return predictions, embeddings, None
+
+def predict_batch(img_batch, backend="keras"):
+    """
+    Runs a batch of preprocessed images (N x 224 x 224 x 3) through a backend.
+    Returns (raw model outputs, error message).
+    """
+    if backend == "keras":
+        model, error_msg = load_prediction_model()
+        if model is None:
+            return None, error_msg
+        return model.predict(img_batch, verbose=0), None
+
+    if backend == "tflite":
+        loaded, error_msg = load_tflite_interpreter()
+        if loaded is None:
+            return None, error_msg
+        interpreter, input_scale = loaded
+        return _run_tflite(interpreter, input_scale, img_batch), None
+
+    return None, f"Unknown backend '{backend}'. Choose from {', '.join(BACKENDS)}."
+
+def predict_disease(image_file, backend="keras"):
+    # Prepare Image
+    img_array = preprocess_image(image_file)
+    img_array = np.expand_dims(img_array, 0)
+
+    # Predict (the Keras path also returns the pooled embedding)
+    embedding = None
+    if backend == "keras":
+        predictions, embeddings, error_msg = predict_batch_with_embeddings(img_array)
+        if embeddings is not None:
+            embedding = embeddings[0]
+    else:
+        predictions, error_msg = predict_batch(img_array, backend=backend)
+
+    if predictions is None:
+        return {"error": f"❌ {error_msg}"}
 
-    # Predict
-    predictions = model.predict(img_array)
     score = tf.nn.softmax(predictions[0]) 
     
     winner_index = np.argmax(score)
@@ -116,5 +294,6 @@ def predict_disease(image_file):
     return {
         "class": predicted_class,
         "confidence": f"{confidence_score:.2f}%",
-        "raw_score": confidence_score
+        "raw_score": confidence_score,
+        "embedding": embedding
     }
\ No newline at end of file
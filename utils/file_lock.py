@@ -0,0 +1,44 @@
+import contextlib
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows: locks only cover threads of this process
+    fcntl = None
+
+_thread_locks = {}
+_registry_lock = threading.Lock()
+_held = threading.local()  # per thread: {path: nesting depth}
+
+@contextlib.contextmanager
+def file_lock(path):
+    """
+    Exclusive lock for a read-modify-write of `path` (and its side files).
+
+    Threads of this process share a re-entrant lock per path; other
+    processes are kept out with flock on `<path>.lock` where available,
+    taken only by the outermost call on a thread so nesting doesn't block
+    on its own flock. Readers don't take it: files are replaced atomically.
+    """
+    key = os.path.abspath(path)
+    with _registry_lock:
+        lock = _thread_locks.setdefault(key, threading.RLock())
+    if not hasattr(_held, "depth"):
+        _held.depth = {}
+
+    with lock:
+        depth = _held.depth.get(key, 0)
+        _held.depth[key] = depth + 1
+        try:
+            if fcntl is None or depth:
+                yield
+                return
+            with open(f"{path}.lock", "a") as f:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        finally:
+            _held.depth[key] = depth
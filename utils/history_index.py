@@ -0,0 +1,67 @@
+import threading
+
+class HistoryIndex:
+    """
+    Per-user secondary index on (crop, date) over the history file.
+
+    A user's entry holds their records (images deferred, see record_stream)
+    and maps each crop and each day ('YYYY-MM-DD') to record positions. It is
+    built on first query and reused until the history file signature
+    (mtime, size) changes, so filter reruns don't walk the whole list again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._users = {}
+
+    def _entry(self, user, signature, load_records):
+        with self._lock:
+            entry = self._users.get(user)
+            if entry is not None and entry["signature"] == signature:
+                return entry
+
+        records = load_records()
+        by_crop, by_date = {}, {}
+        for pos, item in enumerate(records):
+            by_crop.setdefault(item.get('crop'), []).append(pos)
+            by_date.setdefault(item.get('timestamp', '').split(" ")[0], []).append(pos)
+        entry = {"signature": signature, "records": records, "by_crop": by_crop, "by_date": by_date}
+        with self._lock:
+            self._users[user] = entry
+        return entry
+
+    def records(self, user, signature, load_records):
+        """All of the user's records, oldest first. `load_records()` builds the list on a miss."""
+        return self._entry(user, signature, load_records)["records"]
+
+    def query(self, user, signature, load_records, crop=None, date=None):
+        """Returns the user's matching records, newest first."""
+        entry = self._entry(user, signature, load_records)
+        records = entry["records"]
+        if crop is None and date is None:
+            return records[::-1]
+
+        lists = []
+        if crop is not None: lists.append(entry["by_crop"].get(crop, []))
+        if date is not None: lists.append(entry["by_date"].get(str(date), []))
+        lists.sort(key=len)
+        if len(lists) == 1:
+            positions = lists[0]
+        else:
+            other = set(lists[1])
+            positions = [p for p in lists[0] if p in other]
+        return [records[p] for p in reversed(positions)]
+
+    def drop(self, user):
+        with self._lock:
+            self._users.pop(user, None)
+
+# --- TOMBSTONES ---
+# Clearing a user's history records {user: N} ("the first N records are
+# gone") in a small side file instead of rewriting history.json. The records
+# are skipped by iter_history and physically dropped by the next history rewrite.
+# N is positional, so writers of either file must hold file_lock(history file).
+def clear_user(tombstones, user, count):
+    """Marks `user`'s first `count` live records as deleted. Returns the tombstones."""
+    tombstones[user] = tombstones.get(user, 0) + count
+    return tombstones
@@ -0,0 +1,288 @@
+"""
+Versioned model registry with zero-downtime hot-swap and shadow evaluation.
+
+Layout:
+    models/registry/
+        v1/plant_disease_model.h5
+        v2/plant_disease_model.h5
+        ACTIVE              <- name of the live version
+        shadow_log.jsonl    <- one line per shadowed prediction
+
+Register and activate versions from the command line:
+    python -m utils.model_registry register path/to/plant_disease_model.h5 --version v2
+    python -m utils.model_registry activate v2
+Running apps pick up a new ACTIVE version on their next poll.
+"""
+import argparse
+import collections
+import datetime
+import json
+import os
+import random
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+REGISTRY_DIR = os.path.join("models", "registry")
+ACTIVE_FILE = os.path.join(REGISTRY_DIR, "ACTIVE")
+SHADOW_LOG_FILE = os.path.join(REGISTRY_DIR, "shadow_log.jsonl")
+MODEL_FILENAME = "plant_disease_model.h5"
+
+# --- REGISTRY ---
+def version_path(version):
+    return os.path.join(REGISTRY_DIR, version, MODEL_FILENAME)
+
+def list_versions():
+    if not os.path.isdir(REGISTRY_DIR):
+        return []
+    return sorted(v for v in os.listdir(REGISTRY_DIR) if os.path.exists(version_path(v)))
+
+def get_active_version():
+    try:
+        with open(ACTIVE_FILE, "r") as f:
+            version = f.read().strip()
+    except FileNotFoundError:
+        return None
+    return version if version and os.path.exists(version_path(version)) else None
+
+def active_model_path():
+    """Returns (version, weights path) for the active version, or (None, None)."""
+    version = get_active_version()
+    return (version, version_path(version)) if version else (None, None)
+
+def set_active_version(version):
+    if not os.path.exists(version_path(version)):
+        raise ValueError(f"Unknown model version '{version}'")
+    tmp_path = f"{ACTIVE_FILE}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(version)
+    os.replace(tmp_path, ACTIVE_FILE)
+
+def register_version(weights_file, version=None):
+    """Copies an .h5 file into a new registry version and returns its name."""
+    version = version or datetime.datetime.now().strftime("v%Y%m%d-%H%M%S")
+    if os.path.exists(version_path(version)):
+        raise ValueError(f"Model version '{version}' already exists")
+    os.makedirs(os.path.dirname(version_path(version)), exist_ok=True)
+    shutil.copyfile(weights_file, version_path(version))
+    return version
+
+# --- HOT-SWAP & SHADOW ---
+class ModelManager:
+    """
+    Loads registry versions on background threads and swaps them in once warm.
+
+    A watcher thread polls ACTIVE so every app process follows promotions.
+    In shadow mode a sampled fraction of live Keras predictions is replayed
+    on a candidate version off the request thread, recording latency and
+    top-1 agreement with the live model.
+    """
+
+    def __init__(self, poll_seconds=15, max_shadow_backlog=8):
+        self.poll_seconds = poll_seconds
+        self.max_shadow_backlog = max_shadow_backlog
+        self._lock = threading.Lock()
+        self._loading = None
+        self.last_error = None
+        self._watcher = None
+
+        self._shadow = None  # (version, model, sample_rate)
+        self._shadow_loading = None
+        self._shadow_generation = 0  # bumped by start/stop so stale loads are dropped
+        self._shadow_pool = ThreadPoolExecutor(max_workers=1)
+        self._shadow_pending = 0
+        self._shadow_results = collections.deque(maxlen=1000)
+
+    @property
+    def loading(self):
+        return self._loading
+
+    def swap_to(self, version, activate=False):
+        """
+        Warms `version` in the background, then makes it live. With
+        `activate`, ACTIVE is only pointed at it once it has loaded, so a
+        broken version never reaches other processes. Returns False if busy.
+        """
+        from utils import ai_brain
+
+        with self._lock:
+            if self._loading is not None:
+                return False
+            self._loading = version
+
+        def load():
+            try:
+                ai_brain.load_version(version_path(version), version)
+                if activate:
+                    set_active_version(version)
+                self.last_error = None
+                print(f"🔁 Model version {version} is now live")
+            except Exception as e:
+                self.last_error = f"Loading {version} failed: {e}"
+            finally:
+                with self._lock:
+                    self._loading = None
+
+        threading.Thread(target=load, daemon=True).start()
+        return True
+
+    def promote(self, version):
+        if not os.path.exists(version_path(version)):
+            raise ValueError(f"Unknown model version '{version}'")
+        return self.swap_to(version, activate=True)
+
+    def start_watcher(self):
+        if self._watcher is not None:
+            return
+
+        def watch():
+            from utils import ai_brain
+            failed = None
+            while True:
+                active = get_active_version()
+                # Don't retry a version that just failed until ACTIVE changes
+                if active and active != failed and active != ai_brain.get_live_version() and self._loading is None:
+                    self.swap_to(active)
+                    while self._loading is not None:
+                        time.sleep(0.5)
+                    failed = active if ai_brain.get_live_version() != active else None
+                time.sleep(self.poll_seconds)
+
+        self._watcher = threading.Thread(target=watch, daemon=True)
+        self._watcher.start()
+
+    def start_shadow(self, version, sample_rate=0.1):
+        """Loads `version` as a shadow candidate in the background. Returns False if busy."""
+        from utils import ai_brain
+
+        with self._lock:
+            if self._shadow_loading is not None:
+                return False
+            self._shadow_generation += 1
+            generation = self._shadow_generation
+            self._shadow_loading = version
+
+        def load():
+            try:
+                model = ai_brain.load_model_from_path(version_path(version))
+                model.predict(np.zeros((1, 224, 224, 3), dtype=np.float32), verbose=0)
+                with self._lock:
+                    # stop_shadow() was clicked while this was loading
+                    if generation != self._shadow_generation:
+                        return
+                    self._shadow = (version, model, sample_rate)
+                    self._shadow_results.clear()
+                    ai_brain.set_shadow_hook(self._on_live_prediction)
+            except Exception as e:
+                self.last_error = f"Loading shadow {version} failed: {e}"
+            finally:
+                with self._lock:
+                    if generation == self._shadow_generation:
+                        self._shadow_loading = None
+
+        threading.Thread(target=load, daemon=True).start()
+        return True
+
+    def stop_shadow(self):
+        """Stops shadowing, including a candidate that is still loading."""
+        from utils import ai_brain
+        with self._lock:
+            self._shadow_generation += 1
+            self._shadow_loading = None
+            ai_brain.set_shadow_hook(None)
+            self._shadow = None
+
+    @property
+    def shadow_loading(self):
+        return self._shadow_loading
+
+    @property
+    def shadow_version(self):
+        shadow = self._shadow
+        return shadow[0] if shadow else None
+
+    def _on_live_prediction(self, img_batch, predictions, latency):
+        from utils import ai_brain
+
+        shadow = self._shadow
+        if shadow is None or random.random() >= shadow[2]:
+            return
+        with self._lock:
+            # Never let a slow candidate build up an unbounded queue
+            if self._shadow_pending >= self.max_shadow_backlog:
+                return
+            self._shadow_pending += 1
+        live_version = ai_brain.get_live_version()
+        self._shadow_pool.submit(self._run_shadow, shadow, live_version,
+                                 np.array(img_batch), np.array(predictions), latency)
+
+    def _run_shadow(self, shadow, live_version, img_batch, live_predictions, live_latency):
+        version, model, _ = shadow
+        try:
+            start = time.perf_counter()
+            candidate = model.predict(img_batch, verbose=0)
+            shadow_latency = time.perf_counter() - start
+            agree = np.argmax(candidate, axis=1) == np.argmax(live_predictions, axis=1)
+            entry = {
+                "time": str(datetime.datetime.now()),
+                "live_version": live_version,
+                "shadow_version": version,
+                "live_latency_ms": 1000 * live_latency,
+                "shadow_latency_ms": 1000 * shadow_latency,
+                "agreement": float(np.mean(agree)),
+            }
+            self._shadow_results.append(entry)
+            os.makedirs(REGISTRY_DIR, exist_ok=True)
+            with open(SHADOW_LOG_FILE, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+        except Exception as e:
+            self.last_error = f"Shadow prediction failed: {e}"
+        finally:
+            with self._lock:
+                self._shadow_pending -= 1
+
+    def shadow_summary(self):
+        results = list(self._shadow_results)
+        if not results:
+            return None
+        live = np.array([r["live_latency_ms"] for r in results])
+        shadow = np.array([r["shadow_latency_ms"] for r in results])
+        return {
+            "samples": len(results),
+            "agreement": float(np.mean([r["agreement"] for r in results])),
+            "live_p50_ms": float(np.percentile(live, 50)),
+            "live_p95_ms": float(np.percentile(live, 95)),
+            "shadow_p50_ms": float(np.percentile(shadow, 50)),
+            "shadow_p95_ms": float(np.percentile(shadow, 95)),
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage Leaf Doctor model versions.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    reg = sub.add_parser("register", help="Copy an .h5 file into the registry")
+    reg.add_argument("weights_file")
+    reg.add_argument("--version")
+    reg.add_argument("--activate", action="store_true")
+    act = sub.add_parser("activate", help="Make a version live in all running apps")
+    act.add_argument("version")
+    sub.add_parser("list", help="List registered versions")
+    args = parser.parse_args()
+
+    if args.command == "register":
+        version = register_version(args.weights_file, args.version)
+        print(f"✅ Registered {version}")
+        if args.activate:
+            set_active_version(version)
+            print(f"🔁 {version} is now active")
+    elif args.command == "activate":
+        set_active_version(args.version)
+        print(f"🔁 {args.version} is now active")
+    else:
+        active = get_active_version()
+        for version in list_versions():
+            print(f"{'*' if version == active else ' '} {version}")
+
+if __name__ == "__main__":
+    main()
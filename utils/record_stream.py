@@ -0,0 +1,149 @@
+"""
+Streaming readers for history.json and posts.json.
+
+json.load builds the whole tree, base64 images included. These readers walk
+the file in fixed-size chunks and yield one record at a time, so peak memory
+is bounded by the largest single record rather than the file.
+
+Image fields can be skipped, kept, or deferred: a deferred record carries an
+'image_ref' (path, start, end, key) byte range instead of the image, and
+load_image(ref) reads just that record back when the image is shown. The
+key (record id or timestamp) is checked on the way back, so a ref that went
+stale after the file was rewritten returns None rather than another image.
+
+The files are written by json.dump with the default ensure_ascii=True, so
+they are pure ASCII and character offsets are byte offsets.
+"""
+import json
+import re
+
+CHUNK_SIZE = 1 << 20
+_decoder = json.JSONDecoder()
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+class _ChunkReader:
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.base = 0  # file offset of buf[0]
+        self.eof = False
+
+    def _fill(self):
+        # Drop what's been consumed, then read at least as much as is buffered
+        # so a record larger than a chunk is re-scanned O(log n) times, not O(n).
+        self.base += self.pos
+        self.buf = self.buf[self.pos:]
+        self.pos = 0
+        data = self.f.read(max(self.chunk_size, len(self.buf)))
+        if not data:
+            self.eof = True
+            return False
+        self.buf += data.decode("latin-1")
+        return True
+
+    def peek(self):
+        while True:
+            self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"Expected '{char}' at offset {self.base + self.pos}")
+        self.pos += 1
+
+    def value(self):
+        """Decodes the next JSON value. Returns (value, start offset, end offset)."""
+        self.peek()
+        while True:
+            try:
+                obj, end = _decoder.raw_decode(self.buf, self.pos)
+                # A number at the very end of the buffer may continue in the next chunk
+                if end < len(self.buf) or self.eof:
+                    start = self.base + self.pos
+                    self.pos = end
+                    return obj, start, self.base + end
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            if not self._fill():
+                self.eof = True
+
+    def items(self, close):
+        """Yields after each element of the open array/object until `close`."""
+        if self.peek() == close:
+            self.pos += 1
+            return
+        while True:
+            yield
+            char = self.peek()
+            self.pos += 1
+            if char == close:
+                return
+            if char != ",":
+                raise ValueError(f"Expected ',' or '{close}' at offset {self.base + self.pos - 1}")
+
+def _prepare(record, path, start, end, images):
+    if images == "load" or not isinstance(record, dict):
+        return record
+    if record.pop('image', None) is not None and images == "defer":
+        record['image_ref'] = (path, start, end, record.get('id') or record.get('timestamp'))
+    return record
+
+def iter_history(path, tombstones=None, images="skip", chunk_size=CHUNK_SIZE):
+    """
+    Yields (user, record) from a {user: [records]} file.
+    `images` is "skip", "defer" or "load"; `tombstones` is {user: N} as
+    written by history_index.clear_user (the first N records are skipped).
+    """
+    tombstones = tombstones or {}
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return
+    with f:
+        reader = _ChunkReader(f, chunk_size)
+        if reader.peek() == "":
+            return
+        reader.expect("{")
+        for _ in reader.items("}"):
+            user, _, _ = reader.value()
+            reader.expect(":")
+            reader.expect("[")
+            skip = tombstones.get(user, 0)
+            for i, _ in enumerate(reader.items("]")):
+                record, start, end = reader.value()
+                if i >= skip:
+                    yield user, _prepare(record, path, start, end, images)
+
+def iter_posts(path, images="skip", chunk_size=CHUNK_SIZE):
+    """Yields post records from a [posts] file. `images` as in iter_history."""
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return
+    with f:
+        reader = _ChunkReader(f, chunk_size)
+        if reader.peek() == "":
+            return
+        reader.expect("[")
+        for _ in reader.items("]"):
+            record, start, end = reader.value()
+            yield _prepare(record, path, start, end, images)
+
+def load_image(image_ref):
+    """Reads back the base64 image of a record yielded with images="defer"."""
+    path, start, end, key = image_ref
+    try:
+        with open(path, "rb") as f:
+            f.seek(start)
+            record = json.loads(f.read(end - start).decode("latin-1"))
+    except (OSError, ValueError):
+        return None
+    if not isinstance(record, dict) or (record.get('id') or record.get('timestamp')) != key:
+        return None
+    return record.get('image')
@@ -0,0 +1,349 @@
+"""
+Retention and compaction for history.json and posts.json.
+
+Images older than `recompress_after_days` are downscaled and re-encoded;
+records older than `archive_after_days` move out of the hot files into
+gzip-compressed JSON-lines segments under `archive_dir`, which the admin
+table can still read with iter_archived().
+
+Run it from the admin dashboard or from the command line:
+    python -m utils.retention --recompress-days 30 --archive-days 180
+"""
+import argparse
+import base64
+import datetime
+import glob
+import gzip
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from PIL import Image
+
+from utils.file_lock import file_lock
+from utils.record_stream import iter_history, iter_posts
+
+DEFAULT_CONFIG = {
+    "recompress_after_days": 30,
+    "archive_after_days": 180,
+    "max_image_side": 512,
+    "jpeg_quality": 70,
+    "archive_dir": "archive",
+}
+
+def _record_date(record):
+    try:
+        return datetime.date.fromisoformat(str(record.get('timestamp', ''))[:10])
+    except ValueError:
+        return None
+
+def _file_size(path):
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+def write_json_atomic(path, data):
+    """Writes to a temp file and renames it, so readers see the old or new file, never half of one."""
+    # Unique per writer so the app and the compaction thread never share a temp file
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=4)
+    os.replace(tmp_path, path)
+
+def write_json_array_atomic(path, records):
+    """write_json_atomic for a list given as an iterable, written one record per line as it's consumed."""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, "w") as f:
+            f.write("[")
+            for i, record in enumerate(records):
+                f.write(("," if i else "") + "\n    " + json.dumps(record))
+            f.write("\n]")
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+
+def write_json_object_atomic(path, pairs):
+    """
+    write_json_atomic for a {key: [values]} object given as (key, value)
+    pairs, consumed one at a time. Pairs must be grouped by key.
+    """
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, "w") as f:
+            f.write("{")
+            keys, current = set(), None
+            for key, value in pairs:
+                if key != current:
+                    if key in keys:
+                        raise ValueError(f"Key {key!r} is not grouped")
+                    f.write(("\n    ]," if current is not None else "") + f"\n    {json.dumps(key)}: [")
+                    keys.add(key)
+                    current, first = key, True
+                f.write(("" if first else ",") + "\n        " + json.dumps(value))
+                first = False
+            f.write("\n    ]\n}" if current is not None else "}")
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+
+def recompress_image(base64_str, max_side, quality):
+    """Returns a smaller base64 JPEG, or None if re-encoding wouldn't save anything."""
+    img = Image.open(io.BytesIO(base64.b64decode(base64_str)))
+    img.draft("RGB", (max_side, max_side))
+    img = img.convert("RGB")
+    img.thumbnail((max_side, max_side))
+    buffered = io.BytesIO()
+    img.save(buffered, format="JPEG", quality=quality, optimize=True)
+    new_str = base64.b64encode(buffered.getvalue()).decode()
+    return new_str if len(new_str) < len(base64_str) else None
+
+def _compact_record(record, today, config, stats):
+    """Returns 'archive', or recompresses the image in place and returns 'keep'."""
+    day = _record_date(record)
+    if day is None:
+        return "keep"
+    age = (today - day).days
+    if age >= config["archive_after_days"]:
+        return "archive"
+    if age >= config["recompress_after_days"] and record.get('image') and not record.get('compacted'):
+        try:
+            smaller = recompress_image(record['image'], config["max_image_side"], config["jpeg_quality"])
+            if smaller is not None:
+                stats["images_recompressed"] += 1
+                record['image'] = smaller
+        except Exception:
+            stats["image_errors"] += 1
+        record['compacted'] = True
+    return "keep"
+
+class _Segment:
+    """A gzip JSON-lines archive segment written record by record; it only appears once committed."""
+
+    def __init__(self, archive_dir, kind):
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        self.path = os.path.join(archive_dir, f"{kind}-{stamp}.jsonl.gz")
+        self.tmp_path = f"{self.path}.tmp"
+        self.archive_dir = archive_dir
+        self.count = 0
+        self.ids = []
+        self._file = None
+        self._committed = False
+
+    def write(self, record):
+        if self._file is None:
+            os.makedirs(self.archive_dir, exist_ok=True)
+            self._file = gzip.open(self.tmp_path, "wt")
+        self._file.write(json.dumps(record) + "\n")
+        self.count += 1
+        if record.get('id'): self.ids.append(record['id'])
+
+    def commit(self):
+        """Returns the segment path, or None if nothing was archived."""
+        if self._file is None:
+            return None
+        self._file.close()
+        os.replace(self.tmp_path, self.path)
+        self._committed = True
+        return self.path
+
+    def discard(self):
+        """Drops the segment after a failed rewrite; its records are still in the hot file."""
+        if self._file is None:
+            return
+        self._file.close()
+        os.remove(self.path if self._committed else self.tmp_path)
+        self._committed = False
+
+def _load(path, default):
+    if not os.path.exists(path) or not os.path.getsize(path):
+        return default
+    with open(path, "r") as f:
+        return json.load(f)
+
+def _record_key(record):
+    return record.get('id') or hashlib.sha1(json.dumps(record, sort_keys=True).encode()).hexdigest()
+
+def _plan(records, today, config, stats, spill):
+    """
+    Does the slow part (image re-encoding) on a streamed snapshot, without
+    any lock. New images go to the `spill` file, so only keys and offsets
+    are kept. Returns ({key: (offset, compacted)} for changed records,
+    {keys to archive}).
+    """
+    updates, archive = {}, set()
+    for rec in records:
+        key = _record_key(rec)  # before the image changes
+        was_compacted = rec.get('compacted')
+        if _compact_record(rec, today, config, stats) == "archive":
+            archive.add(key)
+        elif rec.get('compacted') != was_compacted:
+            updates[key] = (spill.tell(), rec['compacted'])
+            spill.write(json.dumps(rec.get('image')).encode() + b"\n")
+    return updates, archive
+
+def _merge(record, updates, spill):
+    key = _record_key(record)
+    if key in updates:
+        offset, record['compacted'] = updates[key]
+        spill.seek(offset)
+        record['image'] = json.loads(spill.readline())
+    return key
+
+# Both compactors stream a snapshot to plan, then stream the live files again
+# under the same file_lock the app's writers use and merge: records appended,
+# cleared or commented on in the meantime are kept as they are now. Only one
+# record (plus keys and offsets) is in memory at a time.
+def compact_history(history_file, config, stats, tombstones_file=None, on_archived=None):
+    if not os.path.exists(history_file):
+        return stats
+    today = datetime.date.today()
+    segment = _Segment(config["archive_dir"], "history")
+    with tempfile.TemporaryFile() as spill:
+        tombstones = _load(tombstones_file, {}) if tombstones_file else {}
+        snapshot = (rec for _, rec in iter_history(history_file, tombstones, images="load"))
+        updates, archive = _plan(snapshot, today, config, stats, spill)
+
+        def kept():
+            for user, rec in iter_history(history_file, tombstones, images="load"):
+                if _merge(rec, updates, spill) in archive:
+                    segment.write(dict(rec, user=user))
+                else:
+                    yield user, rec
+            # Archive first: a crash before the rewrite duplicates records, never loses them
+            segment.commit()
+
+        with file_lock(history_file):
+            tombstones = _load(tombstones_file, {}) if tombstones_file else {}
+            if tombstones_file:
+                write_json_atomic(tombstones_file, {})
+            try:
+                write_json_object_atomic(history_file, kept())
+            except BaseException:
+                segment.discard()
+                if tombstones_file:
+                    write_json_atomic(tombstones_file, tombstones)
+                raise
+
+    if on_archived and segment.ids: on_archived(segment.ids)
+    stats["records_archived"] += segment.count
+    if segment.count: stats["segments"].append(segment.path)
+    return stats
+
+def compact_posts(posts_file, config, stats, on_archived=None):
+    if not os.path.exists(posts_file):
+        return stats
+    today = datetime.date.today()
+    segment = _Segment(config["archive_dir"], "posts")
+    with tempfile.TemporaryFile() as spill:
+        updates, archive = _plan(iter_posts(posts_file, images="load"), today, config, stats, spill)
+
+        def kept():
+            for post in iter_posts(posts_file, images="load"):
+                if _merge(post, updates, spill) in archive:
+                    segment.write(post)
+                else:
+                    yield post
+            segment.commit()
+
+        with file_lock(posts_file):
+            try:
+                write_json_array_atomic(posts_file, kept())
+            except BaseException:
+                segment.discard()
+                raise
+
+    if on_archived and segment.ids: on_archived(segment.ids)
+    stats["records_archived"] += segment.count
+    if segment.count: stats["segments"].append(segment.path)
+    return stats
+
+def run_compaction(history_file, posts_file, config=None, tombstones_file=None, on_archived=None):
+    """
+    Compacts both files and returns a report including bytes reclaimed.
+    `on_archived(ids)` is called with the ids moved out of each file.
+    """
+    config = {**DEFAULT_CONFIG, **(config or {})}
+    start = time.perf_counter()
+    bytes_before = _file_size(history_file) + _file_size(posts_file)
+    stats = {"images_recompressed": 0, "image_errors": 0, "records_archived": 0, "segments": []}
+
+    compact_history(history_file, config, stats, tombstones_file, on_archived)
+    compact_posts(posts_file, config, stats, on_archived)
+
+    archive_bytes = sum(_file_size(p) for p in stats["segments"])
+    bytes_after = _file_size(history_file) + _file_size(posts_file)
+    stats.update({
+        "bytes_before": bytes_before,
+        "bytes_after": bytes_after,
+        "archive_bytes_written": archive_bytes,
+        "bytes_reclaimed": bytes_before - bytes_after - archive_bytes,
+        "seconds": time.perf_counter() - start,
+    })
+    return stats
+
+def iter_archived(kind, archive_dir=DEFAULT_CONFIG["archive_dir"]):
+    """Streams archived records ('history' or 'posts'), oldest segment first."""
+    for path in sorted(glob.glob(os.path.join(archive_dir, f"{kind}-*.jsonl.gz"))):
+        with gzip.open(path, "rt") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+class CompactionJob:
+    """Runs run_compaction on a daemon thread so app reruns never wait on it."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self.last_report = None
+        self.last_error = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, *args, **kwargs):
+        with self._lock:
+            if self.running:
+                return False
+            self._thread = threading.Thread(target=self._run, args=args, kwargs=kwargs, daemon=True)
+            self._thread.start()
+            return True
+
+    def _run(self, *args, **kwargs):
+        try:
+            self.last_report = run_compaction(*args, **kwargs)
+            self.last_error = None
+        except Exception as e:
+            self.last_error = str(e)
+
+def main():
+    parser = argparse.ArgumentParser(description="Recompress old images and archive cold records.")
+    parser.add_argument("--history", default="history.json")
+    parser.add_argument("--tombstones", default="history_tombstones.json")
+    parser.add_argument("--posts", default="posts.json")
+    parser.add_argument("--recompress-days", type=int, default=DEFAULT_CONFIG["recompress_after_days"])
+    parser.add_argument("--archive-days", type=int, default=DEFAULT_CONFIG["archive_after_days"])
+    parser.add_argument("--max-side", type=int, default=DEFAULT_CONFIG["max_image_side"])
+    parser.add_argument("--quality", type=int, default=DEFAULT_CONFIG["jpeg_quality"])
+    parser.add_argument("--archive-dir", default=DEFAULT_CONFIG["archive_dir"])
+    args = parser.parse_args()
+
+    report = run_compaction(args.history, args.posts, {
+        "recompress_after_days": args.recompress_days,
+        "archive_after_days": args.archive_days,
+        "max_image_side": args.max_side,
+        "jpeg_quality": args.quality,
+        "archive_dir": args.archive_dir,
+    }, tombstones_file=args.tombstones)
+
+    print(f"🧹 Recompressed {report['images_recompressed']} image(s), archived {report['records_archived']} record(s)")
+    print(f"💾 {report['bytes_before']:,} → {report['bytes_after']:,} bytes "
+          f"(+{report['archive_bytes_written']:,} archived), reclaimed {report['bytes_reclaimed']:,} bytes")
+
+if __name__ == "__main__":
+    main()
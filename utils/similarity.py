@@ -0,0 +1,185 @@
+import json
+import os
+import threading
+import numpy as np
+
+from utils.ai_brain import EMBEDDING_DIM
+
+# --- CONFIGURATION ---
+# Vectors are kept as an append-only float16 file (2.5 KB per scan) plus a
+# JSON-lines sidecar with one {"id", "kind", "user"} entry per row. Rows of
+# cleared or archived records are masked, and their ids appended to a third file.
+VECTORS_FILE = "embeddings.f16"
+META_FILE = "embeddings.jsonl"
+REMOVED_FILE = "embeddings.removed"
+
+class EmbeddingIndex:
+    """
+    Brute-force cosine-similarity index over leaf embeddings.
+
+    Rows are L2-normalised on insert, so a search is a single matrix-vector
+    product over the in-memory float32 matrix. Inserts append to the on-disk
+    files and grow the matrix by doubling, so neither ever rewrites old rows.
+    Removing rows only clears their bit in an alive mask that search applies.
+    """
+
+    def __init__(self, vectors_file=VECTORS_FILE, meta_file=META_FILE, dim=EMBEDDING_DIM,
+                 removed_file=REMOVED_FILE):
+        self.vectors_file = vectors_file
+        self.meta_file = meta_file
+        self.removed_file = removed_file
+        self.dim = dim
+        self._lock = threading.Lock()
+        self._matrix = np.zeros((0, dim), dtype=np.float32)
+        # Integer codes per row so kind/user filters stay vectorized
+        self._kind_codes = np.zeros(0, dtype=np.int32)
+        self._user_codes = np.zeros(0, dtype=np.int32)
+        self._alive = np.zeros(0, dtype=bool)
+        self._codes = {}
+        self._size = 0
+        self._meta = []
+        self._positions = {}
+        self._load()
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, record_id):
+        return record_id in self._positions
+
+    def _load(self):
+        if not (os.path.exists(self.vectors_file) and os.path.exists(self.meta_file)):
+            return
+
+        with open(self.meta_file, "r") as f:
+            meta = []
+            for line in f:
+                try:
+                    meta.append(json.loads(line))
+                except ValueError:
+                    break
+        vectors = np.fromfile(self.vectors_file, dtype=np.float16)
+        rows = min(len(meta), vectors.size // self.dim)
+
+        # A crash between the two appends leaves one file a row ahead; drop it.
+        if rows != len(meta) or rows * self.dim != vectors.size:
+            self._truncate(rows, meta[:rows])
+
+        self._matrix = vectors[:rows * self.dim].reshape(rows, self.dim).astype(np.float32)
+        self._size = rows
+        self._meta = meta[:rows]
+        self._positions = {m["id"]: i for i, m in enumerate(self._meta)}
+        self._kind_codes = np.array([self._code("kind", m["kind"]) for m in self._meta], dtype=np.int32)
+        self._user_codes = np.array([self._code("user", m["user"]) for m in self._meta], dtype=np.int32)
+        removed = set()
+        if os.path.exists(self.removed_file):
+            with open(self.removed_file, "r") as f:
+                for line in f:
+                    try:
+                        removed.add(json.loads(line))
+                    except ValueError:
+                        break
+        self._alive = np.array([m["id"] not in removed for m in self._meta], dtype=bool)
+
+    def _code(self, field, value):
+        return self._codes.setdefault((field, value), len(self._codes))
+
+    def _truncate(self, rows, meta):
+        with open(self.vectors_file, "r+b") as f:
+            f.truncate(rows * self.dim * np.dtype(np.float16).itemsize)
+        with open(self.meta_file, "w") as f:
+            for m in meta:
+                f.write(json.dumps(m) + "\n")
+
+    def add(self, record_id, embedding, kind, user=None):
+        """Normalises and appends one embedding. Re-adding an id is a no-op."""
+        vec = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        if vec.size != self.dim:
+            raise ValueError(f"Expected a {self.dim}-d embedding, got {vec.size}")
+        norm = np.linalg.norm(vec)
+        if norm > 0:
+            vec = vec / norm
+        entry = {"id": record_id, "kind": kind, "user": user}
+
+        with self._lock:
+            if record_id in self._positions:
+                return
+            if self._size == len(self._matrix):
+                capacity = max(64, 2 * len(self._matrix))
+                grown = np.zeros((capacity, self.dim), dtype=np.float32)
+                grown[:self._size] = self._matrix[:self._size]
+                self._matrix = grown
+                self._kind_codes = np.resize(self._kind_codes, capacity)
+                self._user_codes = np.resize(self._user_codes, capacity)
+                self._alive = np.resize(self._alive, capacity)
+            self._matrix[self._size] = vec
+            self._kind_codes[self._size] = self._code("kind", kind)
+            self._user_codes[self._size] = self._code("user", user)
+            self._alive[self._size] = True
+            self._positions[record_id] = self._size
+            self._meta.append(entry)
+            self._size += 1
+
+            with open(self.vectors_file, "ab") as f:
+                f.write(vec.astype(np.float16).tobytes())
+            with open(self.meta_file, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+
+    def remove(self, record_ids):
+        """Drops records from future searches. Returns how many were live."""
+        with self._lock:
+            rows = [self._positions[r] for r in record_ids if r in self._positions]
+            return self._remove_rows([i for i in rows if self._alive[i]])
+
+    def remove_user(self, user, kind=None):
+        """Drops all of `user`'s rows, optionally of one kind (e.g. on Clear History)."""
+        with self._lock:
+            mask = self._alive[:self._size] & (self._user_codes[:self._size] == self._codes.get(("user", user), -1))
+            if kind is not None:
+                mask &= self._kind_codes[:self._size] == self._codes.get(("kind", kind), -1)
+            return self._remove_rows(np.flatnonzero(mask))
+
+    def _remove_rows(self, rows):
+        if not len(rows):
+            return 0
+        self._alive[rows] = False
+        with open(self.removed_file, "a") as f:
+            for i in rows:
+                f.write(json.dumps(self._meta[i]["id"]) + "\n")
+        return len(rows)
+
+    def search(self, embedding, k=5, kind=None, user=None, exclude=()):
+        """
+        Returns up to k (meta, score) pairs, most similar first.
+        `kind` / `user` restrict the candidates; `exclude` skips record ids.
+        """
+        with self._lock:
+            size = self._size
+            matrix = self._matrix[:size]
+            kind_codes = self._kind_codes[:size]
+            user_codes = self._user_codes[:size]
+            alive = self._alive[:size].copy()
+            meta = self._meta[:size]
+            excluded = [self._positions[r] for r in exclude if r in self._positions]
+            kind_code = self._codes.get(("kind", kind), -1)
+            user_code = self._codes.get(("user", user), -1)
+        if size == 0 or k <= 0:
+            return []
+
+        query = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        norm = np.linalg.norm(query)
+        if norm > 0:
+            query = query / norm
+        scores = matrix @ query
+
+        if kind is not None:
+            scores[kind_codes != kind_code] = -np.inf
+        if user is not None:
+            scores[user_codes != user_code] = -np.inf
+        scores[excluded] = -np.inf
+        scores[~alive] = -np.inf
+
+        k = min(k, size)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(meta[i], float(scores[i])) for i in top if np.isfinite(scores[i])]
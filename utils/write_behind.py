@@ -0,0 +1,215 @@
+import atexit
+import collections
+import threading
+import time
+import numpy as np
+
+class WriteBehindQueue:
+    """
+    Write-behind persistence with group commit.
+
+    Request threads enqueue writes and return immediately. A flusher thread
+    commits everything queued once `max_batch` items are waiting, the oldest
+    has waited `max_delay` seconds, or the process exits. Items stay visible
+    through pending() until they have been committed, which gives a session
+    read-your-writes over its own unflushed data.
+
+    `commit_fns` maps each kind to a function taking a list of items
+    {"kind", "session", "data", "enqueued", "attempts"} in order; kinds that
+    share a function (one file) are committed together. Each function is
+    called separately and its items leave the queue as soon as it returns,
+    so a failing file never holds back the others. A failed group is retried
+    on the next flush, which means commit functions must skip data that is
+    already stored. An item that has failed `max_attempts` times is retried
+    on its own and, if it still fails, moved to dead_letters() (up to
+    `max_pending` of them).
+
+    At most `max_pending` items are queued; enqueue() waits up to
+    `enqueue_timeout` seconds for room, then raises.
+    """
+
+    def __init__(self, commit_fns, max_batch=32, max_delay=2.0, max_pending=1000,
+                 max_attempts=3, enqueue_timeout=10.0):
+        self.commit_fns = commit_fns
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.enqueue_timeout = enqueue_timeout
+        self._cond = threading.Condition()
+        self._items = []
+        self._in_flight = False
+        self._dead = []
+        self._closed = False
+        self.last_error = None
+
+        self._flush_ms = collections.deque(maxlen=500)
+        self._durable_ms = collections.deque(maxlen=500)
+        self._batch_sizes = collections.deque(maxlen=500)
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def enqueue(self, kind, data, session=None):
+        if kind not in self.commit_fns:
+            raise ValueError(f"Unknown write kind '{kind}'")
+        deadline = time.monotonic() + self.enqueue_timeout
+        with self._cond:
+            # Backpressure: wake the flusher and wait for room rather than grow without bound
+            while not self._closed and len(self._items) >= self.max_pending:
+                self._cond.notify_all()
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise RuntimeError("Write-behind queue is full")
+                self._cond.wait(remaining)
+            if self._closed:
+                raise RuntimeError("Write-behind queue is closed")
+            self._items.append({"kind": kind, "session": session, "data": data,
+                                "enqueued": time.monotonic(), "attempts": 0})
+            # The first item starts the flusher's max_delay timer; a full batch ends it early
+            if len(self._items) == 1 or len(self._items) >= self.max_batch:
+                self._cond.notify_all()
+
+    def pending(self, kind, session=None):
+        """Data of queued or in-flight items of `kind`, oldest first, optionally for one session."""
+        with self._cond:
+            return [i["data"] for i in self._items
+                    if i["kind"] == kind and (session is None or i["session"] == session)]
+
+    def flush(self):
+        """Commits everything queued so far on the calling thread. Returns False if a file failed."""
+        while True:
+            with self._cond:
+                while self._in_flight:
+                    self._cond.wait()
+                if not self._items:
+                    return True
+            if not self._commit_batch():
+                return False
+
+    def close(self):
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout=30)
+        self.flush()
+
+    def dead_letters(self):
+        """Items moved aside after `max_attempts` failures, with their last error."""
+        with self._cond:
+            return list(self._dead)
+
+    def retry_dead_letters(self):
+        with self._cond:
+            for item in self._dead:
+                item["attempts"] = 0
+                item.pop("error", None)
+            self._items[:0] = self._dead
+            self._dead = []
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed:
+                    # A manual flush() is committing; wait for it to finish
+                    if self._in_flight:
+                        self._cond.wait()
+                        continue
+                    waiting = len(self._items)
+                    if waiting >= self.max_batch:
+                        break
+                    if waiting:
+                        age = time.monotonic() - self._items[0]["enqueued"]
+                        if age >= self.max_delay:
+                            break
+                        self._cond.wait(self.max_delay - age)
+                    else:
+                        self._cond.wait()
+                if self._closed:
+                    return
+            if not self._commit_batch():
+                # Back off before retrying a failed file
+                time.sleep(self.max_delay)
+
+    def _commit(self, commit_fn, group):
+        start = time.monotonic()
+        try:
+            commit_fn(group)
+        except Exception as e:
+            self.last_error = str(e)
+            print(f"⚠️ Write-behind flush failed: {e}")
+            for item in group:
+                item["attempts"] += 1
+                item["error"] = str(e)
+            return False
+        done = time.monotonic()
+        with self._cond:
+            committed = set(map(id, group))
+            self._items = [i for i in self._items if id(i) not in committed]
+            self._flush_ms.append(1000 * (done - start))
+            self._batch_sizes.append(len(group))
+            self._durable_ms.extend(1000 * (done - i["enqueued"]) for i in group)
+            self._cond.notify_all()
+        return True
+
+    def _commit_batch(self):
+        with self._cond:
+            if self._in_flight or not self._items:
+                return True
+            batch = list(self._items)
+            self._in_flight = True
+
+        try:
+            groups = {}
+            for item in batch:
+                commit_fn = self.commit_fns[item["kind"]]
+                groups.setdefault(id(commit_fn), (commit_fn, []))[1].append(item)
+
+            ok = True
+            for commit_fn, group in groups.values():
+                if self._commit(commit_fn, group):
+                    continue
+                ok = False
+                if not any(i["attempts"] >= self.max_attempts for i in group):
+                    continue
+                # Isolate the item that keeps failing so the rest of the file can land
+                for item in group:
+                    if not self._commit(commit_fn, [item]) and item["attempts"] >= self.max_attempts:
+                        with self._cond:
+                            # Once this many are set aside the store itself is broken: keep queuing (and throttling)
+                            if len(self._dead) >= self.max_pending:
+                                continue
+                            self._items.remove(item)
+                            self._dead.append(item)
+                        print(f"⚠️ Write-behind gave up on a '{item['kind']}' write: {item['error']}")
+            if ok:
+                self.last_error = None
+            return ok
+        finally:
+            with self._cond:
+                self._in_flight = False
+                self._cond.notify_all()
+
+    def metrics(self):
+        with self._cond:
+            flush_ms = np.array(self._flush_ms)
+            durable_ms = np.array(self._durable_ms)
+            sizes = list(self._batch_sizes)
+            queued = len(self._items)
+            dead = len(self._dead)
+        if not sizes:
+            return {"flushes": 0, "queued": queued, "dead_letters": dead}
+        return {
+            "flushes": len(sizes),
+            "queued": queued,
+            "dead_letters": dead,
+            "mean_batch": float(np.mean(sizes)),
+            "flush_p50_ms": float(np.percentile(flush_ms, 50)),
+            "flush_p95_ms": float(np.percentile(flush_ms, 95)),
+            "durable_p50_ms": float(np.percentile(durable_ms, 50)),
+            "durable_p95_ms": float(np.percentile(durable_ms, 95)),
+        }